@@ -25,14 +25,21 @@
  * Only the delay can be configured.
  *
  * Use the max-delay property to set the maximum amount of delay that
- * will be used. This can only be set before going to the PAUSED or PLAYING
- * state and will be set to the current delay by default.
+ * will be used. It will be raised to the current delay if needed.
+ * The ring buffer is allocated when the caps are set; growing the maximum
+ * delay while running allocates a larger ring buffer (outside of the
+ * streaming thread), which is swapped in at the next buffer boundary
+ * without losing the buffered audio.
+ *
+ * Changes of the delay are picked up at the next buffer boundary, and the
+ * output crossfades from the old to the new delay within fade-time.
  *
  * <refsect2>
  * <title>Example launch line</title>
  * |[
  * gst-launch-1.0 filesrc location="melo1.ogg" ! audioconvert ! audiodelay delay=500000000 ! audioconvert ! autoaudiosink
  * gst-launch-1.0 filesrc location="melo1.ogg" ! decodebin ! audioconvert ! audiodelay delay=50000000 ! audioconvert ! autoaudiosink
+ * gst-launch-1.0 audiotestsrc ! audio/x-raw,format=S16LE ! audiodelay delay=500000000 ! autoaudiosink
  * ]|
  * </refsect2>
  */
@@ -46,21 +53,30 @@
 #include <gst/audio/audio.h>
 #include <gst/audio/gstaudiofilter.h>
 
+#include <string.h>
+
 #include "audiodelay.h"
 
 #define GST_CAT_DEFAULT gst_audio_delay_debug
 GST_DEBUG_CATEGORY_STATIC (GST_CAT_DEFAULT);
 
+/* number of frames processed in one go */
+#define GST_AUDIO_DELAY_BLOCK_FRAMES 1024
+
+#define DEFAULT_FADE_TIME (50 * GST_MSECOND)
+
 enum
   {
     PROP_0,
     PROP_DELAY,
-    PROP_MAX_DELAY
+    PROP_MAX_DELAY,
+    PROP_FADE_TIME
   };
 
 #define ALLOWED_CAPS							\
   "audio/x-raw,"							\
-  " format=(string) {"GST_AUDIO_NE(F32)","GST_AUDIO_NE(F64)"}, "	\
+  " format=(string) {"GST_AUDIO_NE(F32)","GST_AUDIO_NE(F64)","		\
+  GST_AUDIO_NE(S16)","GST_AUDIO_NE(S32)"}, "				\
   " rate=(int)[1,MAX],"							\
   " channels=(int)[1,MAX],"						\
   " layout=(string) interleaved"
@@ -73,6 +89,8 @@ static void gst_audio_delay_set_property (GObject * object, guint prop_id,
 static void gst_audio_delay_get_property (GObject * object, guint prop_id,
 					  GValue * value, GParamSpec * pspec);
 static void gst_audio_delay_finalize (GObject * object);
+static void gst_audio_delay_free (GstAudioDelay * self);
+static void gst_audio_delay_grow (GstAudioDelay * self, guint64 max_delay);
 
 static gboolean gst_audio_delay_setup (GstAudioFilter * self,
 				       const GstAudioInfo * info);
@@ -80,10 +98,35 @@ static gboolean gst_audio_delay_stop (GstBaseTransform * base);
 static GstFlowReturn gst_audio_delay_transform_ip (GstBaseTransform * base,
 						   GstBuffer * buf);
 
-static void gst_audio_delay_transform_float (GstAudioDelay * self,
-					     gfloat * data, guint num_samples);
-static void gst_audio_delay_transform_double (GstAudioDelay * self,
-					      gdouble * data, guint num_samples);
+static void gst_audio_delay_interpolate_float (const guint8 * tap0,
+					      const guint8 * tap1, guint8 * out,
+					      guint num_samples, gdouble frac);
+static void gst_audio_delay_interpolate_double (const guint8 * tap0,
+					       const guint8 * tap1, guint8 * out,
+					       guint num_samples, gdouble frac);
+static void gst_audio_delay_interpolate_int16 (const guint8 * tap0,
+					      const guint8 * tap1, guint8 * out,
+					      guint num_samples, gdouble frac);
+static void gst_audio_delay_interpolate_int32 (const guint8 * tap0,
+					      const guint8 * tap1, guint8 * out,
+					      guint num_samples, gdouble frac);
+
+static void gst_audio_delay_mix_float (const guint8 * from, const guint8 * to,
+				       guint8 * out, guint num_frames,
+				       guint channels, gdouble gain,
+				       gdouble step);
+static void gst_audio_delay_mix_double (const guint8 * from, const guint8 * to,
+					guint8 * out, guint num_frames,
+					guint channels, gdouble gain,
+					gdouble step);
+static void gst_audio_delay_mix_int16 (const guint8 * from, const guint8 * to,
+				       guint8 * out, guint num_frames,
+				       guint channels, gdouble gain,
+				       gdouble step);
+static void gst_audio_delay_mix_int32 (const guint8 * from, const guint8 * to,
+				       guint8 * out, guint num_frames,
+				       guint channels, gdouble gain,
+				       gdouble step);
 
 /* GObject vmethod implementations */
 
@@ -112,10 +155,18 @@ gst_audio_delay_class_init (GstAudioDelayClass * klass)
   g_object_class_install_property (gobject_class, PROP_MAX_DELAY,
 				   g_param_spec_uint64 ("max-delay", "Maximum Delay",
 							"Maximum delay of the delay in nanoseconds"
-							" (can't be changed in PLAYING or PAUSED state)",
+							" (can only grow in PLAYING or PAUSED state)",
 							1, G_MAXUINT64, 1,
 							G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS |
-							GST_PARAM_MUTABLE_READY));
+							GST_PARAM_MUTABLE_PLAYING));
+
+  g_object_class_install_property (gobject_class, PROP_FADE_TIME,
+				   g_param_spec_uint64 ("fade-time", "Fade time",
+							"Time to crossfade to a new delay in nanoseconds"
+							" (0 = jump)",
+							0, G_MAXUINT64, DEFAULT_FADE_TIME,
+							G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS |
+							GST_PARAM_MUTABLE_PLAYING));
 
   gst_element_class_set_static_metadata (gstelement_class, "Audio delay",
 					 "Filter/Effect/Audio",
@@ -138,8 +189,7 @@ gst_audio_delay_init (GstAudioDelay * self)
 {
   self->delay = 1;
   self->max_delay = 1;
-
-  g_mutex_init (&self->lock);
+  self->fade_time = DEFAULT_FADE_TIME;
 
   gst_base_transform_set_in_place (GST_BASE_TRANSFORM (self), TRUE);
 }
@@ -149,12 +199,92 @@ gst_audio_delay_finalize (GObject * object)
 {
   GstAudioDelay *self = GST_AUDIO_DELAY (object);
 
+  gst_audio_delay_free (self);
+
+  G_OBJECT_CLASS (parent_class)->finalize (object);
+}
+
+/* release all buffers (with the object lock held) */
+static void
+gst_audio_delay_free (GstAudioDelay * self)
+{
   g_free (self->buffer);
   self->buffer = NULL;
+  g_free (self->scratch);
+  self->scratch = NULL;
+  g_free (self->pending_buffer);
+  self->pending_buffer = NULL;
+  g_free (self->retired_buffer);
+  self->retired_buffer = NULL;
+  self->buffer_pos = 0;
+  self->buffer_size = 0;
+  self->buffer_size_frames = 0;
+  self->tap.frames = 0;
+  self->fade_pos = 0;
+  self->fade_frames = 0;
+}
 
-  g_mutex_clear (&self->lock);
+/* the size (in frames) of the ring buffer for 'max_delay':
+ * with one block of headroom, so short delays are processed in whole
+ * blocks rather than in spans of the delay (see gst_audio_delay_process())
+ */
+static guint
+gst_audio_delay_ring_frames (guint64 max_delay, guint rate)
+{
+  return MAX (gst_util_uint64_scale (max_delay, rate, GST_SECOND), 1)
+    + GST_AUDIO_DELAY_BLOCK_FRAMES;
+}
 
-  G_OBJECT_CLASS (parent_class)->finalize (object);
+/* allocate a ring buffer for 'max_delay' (if it is larger than the current
+ * one), to be swapped in by the streaming thread.
+ * this is called from the application thread, so the streaming thread
+ * never allocates memory.
+ */
+static void
+gst_audio_delay_grow (GstAudioDelay * self, guint64 max_delay)
+{
+  guint8 *buffer, *unused = NULL, *retired;
+  guint bpf, frames;
+
+  GST_OBJECT_LOCK (self);
+  if (max_delay <= self->max_delay) {
+    GST_OBJECT_UNLOCK (self);
+    return;
+  }
+  self->max_delay = max_delay;
+  if (self->buffer == NULL) {
+    /* not running yet: setup() will allocate the ring buffer */
+    GST_OBJECT_UNLOCK (self);
+    return;
+  }
+  bpf = GST_AUDIO_FILTER_BPF (self);
+  frames = gst_audio_delay_ring_frames (max_delay,
+					GST_AUDIO_FILTER_RATE (self));
+  GST_OBJECT_UNLOCK (self);
+
+  buffer = g_try_malloc0 (frames * bpf);
+  if (buffer == NULL) {
+    GST_ERROR_OBJECT (self, "Failed to allocate %u bytes", frames * bpf);
+    return;
+  }
+
+  GST_OBJECT_LOCK (self);
+  if (self->buffer == NULL || frames <= self->buffer_size_frames
+      || (self->pending_buffer && frames <= self->pending_frames)) {
+    unused = buffer;
+  } else {
+    unused = self->pending_buffer;
+    self->pending_buffer = buffer;
+    self->pending_frames = frames;
+    self->pending_bpf = bpf;
+  }
+  retired = self->retired_buffer;
+  self->retired_buffer = NULL;
+  GST_OBJECT_UNLOCK (self);
+
+  g_free (unused);
+  g_free (retired);
+  g_atomic_int_inc (&self->delay_serial);
 }
 
 static void
@@ -165,47 +295,38 @@ gst_audio_delay_set_property (GObject * object, guint prop_id,
 
   switch (prop_id) {
   case PROP_DELAY:{
-    guint64 max_delay, delay;
-    guint rate;
-
-    g_mutex_lock (&self->lock);
-    delay = g_value_get_uint64 (value);
-    max_delay = self->max_delay;
-
-    if (delay > max_delay && GST_STATE (self) > GST_STATE_READY) {
-      GST_WARNING_OBJECT (self, "New delay (%" GST_TIME_FORMAT ") "
-			  "is larger than maximum delay (%" GST_TIME_FORMAT ")",
-			  GST_TIME_ARGS (delay), GST_TIME_ARGS (max_delay));
-      self->delay = max_delay;
-    } else {
-      self->delay = delay;
-      self->max_delay = MAX (delay, max_delay);
-    }
-    rate = GST_AUDIO_FILTER_RATE (self);
-    if (rate > 0)
-      self->delay_frames =
-	MAX (gst_util_uint64_scale (self->delay, rate, GST_SECOND), 1);
+    guint64 delay = g_value_get_uint64 (value);
+
+    GST_OBJECT_LOCK (self);
+    self->delay = delay;
+    GST_OBJECT_UNLOCK (self);
+
+    /* make room for the new delay (if needed) */
+    gst_audio_delay_grow (self, delay);
 
-    g_mutex_unlock (&self->lock);
+    /* publish the change, the streaming thread picks it up
+     * at the next buffer boundary */
+    g_atomic_int_inc (&self->delay_serial);
     break;
   }
   case PROP_MAX_DELAY:{
-    guint64 max_delay, delay;
-
-    g_mutex_lock (&self->lock);
-    max_delay = g_value_get_uint64 (value);
-    delay = self->delay;
+    guint64 max_delay = g_value_get_uint64 (value);
 
     if (GST_STATE (self) > GST_STATE_READY) {
-      GST_ERROR_OBJECT (self, "Can't change maximum delay in"
-			" PLAYING or PAUSED state");
+      /* the ring buffer can only grow while running */
+      gst_audio_delay_grow (self, max_delay);
     } else {
-      self->delay = delay;
+      GST_OBJECT_LOCK (self);
       self->max_delay = max_delay;
+      GST_OBJECT_UNLOCK (self);
     }
-    g_mutex_unlock (&self->lock);
     break;
   }
+  case PROP_FADE_TIME:
+    GST_OBJECT_LOCK (self);
+    self->fade_time = g_value_get_uint64 (value);
+    GST_OBJECT_UNLOCK (self);
+    break;
   default:
     G_OBJECT_WARN_INVALID_PROPERTY_ID (object, prop_id, pspec);
     break;
@@ -220,14 +341,19 @@ gst_audio_delay_get_property (GObject * object, guint prop_id,
 
   switch (prop_id) {
   case PROP_DELAY:
-    g_mutex_lock (&self->lock);
+    GST_OBJECT_LOCK (self);
     g_value_set_uint64 (value, self->delay);
-    g_mutex_unlock (&self->lock);
+    GST_OBJECT_UNLOCK (self);
     break;
   case PROP_MAX_DELAY:
-    g_mutex_lock (&self->lock);
+    GST_OBJECT_LOCK (self);
     g_value_set_uint64 (value, self->max_delay);
-    g_mutex_unlock (&self->lock);
+    GST_OBJECT_UNLOCK (self);
+    break;
+  case PROP_FADE_TIME:
+    GST_OBJECT_LOCK (self);
+    g_value_set_uint64 (value, self->fade_time);
+    GST_OBJECT_UNLOCK (self);
     break;
   default:
     G_OBJECT_WARN_INVALID_PROPERTY_ID (object, prop_id, pspec);
@@ -242,28 +368,64 @@ gst_audio_delay_setup (GstAudioFilter * base, const GstAudioInfo * info)
 {
   GstAudioDelay *self = GST_AUDIO_DELAY (base);
   gboolean ret = TRUE;
+  guint8 *buffer, *scratch;
+  guint bpf, rate, frames;
 
   switch (GST_AUDIO_INFO_FORMAT (info)) {
   case GST_AUDIO_FORMAT_F32:
-    self->process = (GstAudioDelayProcessFunc)
-      gst_audio_delay_transform_float;
+    self->interpolate = gst_audio_delay_interpolate_float;
+    self->mix = gst_audio_delay_mix_float;
     break;
   case GST_AUDIO_FORMAT_F64:
-    self->process = (GstAudioDelayProcessFunc)
-      gst_audio_delay_transform_double;
+    self->interpolate = gst_audio_delay_interpolate_double;
+    self->mix = gst_audio_delay_mix_double;
+    break;
+  case GST_AUDIO_FORMAT_S16:
+    self->interpolate = gst_audio_delay_interpolate_int16;
+    self->mix = gst_audio_delay_mix_int16;
+    break;
+  case GST_AUDIO_FORMAT_S32:
+    self->interpolate = gst_audio_delay_interpolate_int32;
+    self->mix = gst_audio_delay_mix_int32;
     break;
   default:
     ret = FALSE;
     break;
   }
+  if (!ret)
+    return FALSE;
+
+  bpf = GST_AUDIO_INFO_BPF (info);
+  rate = GST_AUDIO_INFO_RATE (info);
+
+  GST_OBJECT_LOCK (self);
+  gst_audio_delay_free (self);
+  self->max_delay = MAX (self->max_delay, self->delay);
+  frames = gst_audio_delay_ring_frames (self->max_delay, rate);
+  GST_OBJECT_UNLOCK (self);
+
+  buffer = g_try_malloc0 (frames * bpf);
+  /* the second half holds the new delay while crossfading */
+  scratch = g_try_malloc (2 * GST_AUDIO_DELAY_BLOCK_FRAMES * bpf);
+  if (buffer == NULL || scratch == NULL) {
+    g_free (buffer);
+    g_free (scratch);
+    GST_ERROR_OBJECT (self, "Failed to allocate %u bytes", frames * bpf);
+    return FALSE;
+  }
 
-  g_free (self->buffer);
-  self->buffer = NULL;
-  self->buffer_pos = 0;
-  self->buffer_size = 0;
-  self->buffer_size_frames = 0;
+  GST_OBJECT_LOCK (self);
+  self->buffer = buffer;
+  self->buffer_size_frames = frames;
+  self->buffer_size = frames * bpf;
+  self->scratch = scratch;
+  self->scratch_frames = GST_AUDIO_DELAY_BLOCK_FRAMES;
+  GST_OBJECT_UNLOCK (self);
+
+  /* the taps are set by the first buffer */
+  self->applied_serial = g_atomic_int_get (&self->delay_serial) - 1;
 
-  return ret;
+  return TRUE;
 }
 
 static gboolean
@@ -271,63 +433,317 @@ gst_audio_delay_stop (GstBaseTransform * base)
 {
   GstAudioDelay *self = GST_AUDIO_DELAY (base);
 
-  g_free (self->buffer);
-  self->buffer = NULL;
-  self->buffer_pos = 0;
-  self->buffer_size = 0;
-  self->buffer_size_frames = 0;
+  GST_OBJECT_LOCK (self);
+  gst_audio_delay_free (self);
+  GST_OBJECT_UNLOCK (self);
 
   return TRUE;
 }
 
-#define TRANSFORM_FUNC(name, type)					\
+/* linear interpolation between two taps of the ring buffer
+ * (for fractional delays); a single flat loop, so the compiler can vectorize it
+ */
+#define INTERPOLATE_FUNC(name, type)					\
   static void								\
-  gst_audio_delay_transform_##name (GstAudioDelay * self,		\
-				    type * data, guint num_samples)	\
+  gst_audio_delay_interpolate_##name (const guint8 * tap0_,		\
+				      const guint8 * tap1_, guint8 * out_, \
+				      guint num_samples, gdouble frac)	\
   {									\
-    type *buffer = (type *) self->buffer;				\
-    guint channels = GST_AUDIO_FILTER_CHANNELS (self);			\
-    guint rate = GST_AUDIO_FILTER_RATE (self);				\
-    guint i, j;								\
-    guint delay_index = self->buffer_size_frames - self->delay_frames;	\
-    gdouble delay_off = ((((gdouble) self->delay) * rate) / GST_SECOND) - self->delay_frames; \
+    const type *tap0 = (const type *) tap0_;				\
+    const type *tap1 = (const type *) tap1_;				\
+    type *out = (type *) out_;						\
+    type f = frac;							\
+    guint i;								\
 									\
-    if (delay_off < 0.0)						\
-      delay_off = 0.0;							\
-									\
-    num_samples /= channels;						\
+    for (i = 0; i < num_samples; i++)					\
+      out[i] = tap0[i] + (tap1[i] - tap0[i]) * f;			\
+  }
+
+/* integer samples are interpolated in fixed point
+ * (with 'shift' fractional bits, so the products fit into 'acc_type')
+ */
+#define INTERPOLATE_INT_FUNC(name, type, acc_type, shift)		\
+  static void								\
+  gst_audio_delay_interpolate_##name (const guint8 * tap0_,		\
+				      const guint8 * tap1_, guint8 * out_, \
+				      guint num_samples, gdouble frac)	\
+  {									\
+    const type *tap0 = (const type *) tap0_;				\
+    const type *tap1 = (const type *) tap1_;				\
+    type *out = (type *) out_;						\
+    acc_type f = frac * (((acc_type) 1) << shift) + 0.5;		\
+    guint i;								\
 									\
-    for (i = 0; i < num_samples; i++) {					\
-      guint delay0_index = ((delay_index + self->buffer_pos) % self->buffer_size_frames) * channels; \
-      guint delay1_index = ((delay_index + self->buffer_pos +1) % self->buffer_size_frames) * channels; \
-      guint rbout_index = (self->buffer_pos % self->buffer_size_frames) * channels; \
-      for (j = 0; j < channels; j++) {					\
-	gdouble in = data[i*channels + j];				\
-	gdouble delay0 = buffer[delay0_index + j];			\
-	gdouble delay1 = buffer[delay1_index + j];			\
-	gdouble delay = delay0 + (delay1-delay0)*delay_off;		\
-	type out = delay;						\
+    for (i = 0; i < num_samples; i++)					\
+      out[i] = (type) (tap0[i] +					\
+		       ((((acc_type) tap1[i] - tap0[i]) * f) >> shift));	\
+  }
+
+INTERPOLATE_FUNC (float, gfloat);
+INTERPOLATE_FUNC (double, gdouble);
+INTERPOLATE_INT_FUNC (int16, gint16, gint32, 15);
+INTERPOLATE_INT_FUNC (int32, gint32, gint64, 30);
+
+/* crossfade (in place) from one delayed signal to another,
+ * with the gain of the 'to' signal rising by 'step' per frame
+ */
+#define MIX_FUNC(name, type)						\
+  static void								\
+  gst_audio_delay_mix_##name (const guint8 * from_, const guint8 * to_, \
+			      guint8 * out_, guint num_frames,		\
+			      guint channels, gdouble gain, gdouble step) \
+  {									\
+    const type *from = (const type *) from_;				\
+    const type *to = (const type *) to_;				\
+    type *out = (type *) out_;						\
+    guint i, j;								\
 									\
-	data[i*channels + j] = out;					\
-	buffer[rbout_index + j] = in;					\
-      }									\
-      self->buffer_pos = (self->buffer_pos + 1) % self->buffer_size_frames; \
+    for (i = 0; i < num_frames; i++) {					\
+      for (j = 0; j < channels; j++, from++, to++, out++)		\
+	*out = (type) (*from + (*to - (gdouble) *from) * gain);		\
+      gain += step;							\
     }									\
   }
 
-TRANSFORM_FUNC (float, gfloat);
-TRANSFORM_FUNC (double, gdouble);
+MIX_FUNC (float, gfloat);
+MIX_FUNC (double, gdouble);
+MIX_FUNC (int16, gint16);
+MIX_FUNC (int32, gint32);
+
+/* convert a delay (in nanoseconds) to a tap into the ring buffer */
+static void
+gst_audio_delay_set_tap (GstAudioDelay * self, GstAudioDelayTap * tap,
+			 guint64 delay)
+{
+  guint rate = GST_AUDIO_FILTER_RATE (self);
+
+  tap->frames = MAX (gst_util_uint64_scale (delay, rate, GST_SECOND), 1);
+  tap->frac = ((((gdouble) delay) * rate) / GST_SECOND) - tap->frames;
+  if (tap->frac < 0.0)
+    tap->frac = 0.0;
+  if (tap->frames > self->buffer_size_frames) {
+    tap->frames = self->buffer_size_frames;
+    tap->frac = 0.0;
+  }
+}
+
+/* the longest span that can be processed at once with a given tap,
+ * if the delayed frames are read before the input of the span is written
+ * into the ring buffer: it must not read the frames of the span itself
+ * (interpolating also reads the frame after the delayed one)
+ */
+static guint
+gst_audio_delay_span_before (const GstAudioDelayTap * tap)
+{
+  if (tap->frac > 0.0)
+    return tap->frames - 1;
+  return tap->frames;
+}
+
+/* the longest span that can be processed at once with a given tap,
+ * if the input of the span is written into the ring buffer first:
+ * it must not overwrite the frames that are still to be read.
+ * with the headroom of the ring buffer (see gst_audio_delay_ring_frames()),
+ * this is at least a block for any delay up to max-delay
+ */
+static guint
+gst_audio_delay_span_after (const GstAudioDelayTap * tap, guint size)
+{
+  return (size > tap->frames) ? size - tap->frames : 0;
+}
+
+/* swap in a larger ring buffer (allocated by gst_audio_delay_grow()),
+ * keeping the buffered frames in order: the old ring is unrolled to the
+ * start of the new one, and the tail of the new one is silence
+ * (called with the object lock held)
+ */
+static void
+gst_audio_delay_swap (GstAudioDelay * self)
+{
+  guint bpf = GST_AUDIO_FILTER_BPF (self);
+  guint size = self->buffer_size_frames;
+  guint wpos = self->buffer_pos;
+  guint8 *buffer = self->pending_buffer;
+
+  self->pending_buffer = NULL;
+  if (bpf != self->pending_bpf || self->pending_frames <= size) {
+    /* stale (the caps have changed in the meantime) */
+    g_free (self->retired_buffer);
+    self->retired_buffer = buffer;
+    return;
+  }
+
+  memcpy (buffer, self->buffer + wpos * bpf, (size - wpos) * bpf);
+  memcpy (buffer + (size - wpos) * bpf, self->buffer, wpos * bpf);
+
+  /* the old ring is freed by the next gst_audio_delay_grow() */
+  g_free (self->retired_buffer);
+  self->retired_buffer = self->buffer;
+
+  self->buffer = buffer;
+  self->buffer_pos = size;
+  self->buffer_size_frames = self->pending_frames;
+  self->buffer_size = self->pending_frames * bpf;
+}
+
+/* pick up a delay change (published by set_property) */
+static void
+gst_audio_delay_update (GstAudioDelay * self)
+{
+  gint serial = g_atomic_int_get (&self->delay_serial);
+  GstAudioDelayTap tap;
+  guint64 delay, fade_time;
+
+  if (serial == self->applied_serial)
+    return;
+
+  GST_OBJECT_LOCK (self);
+  if (self->pending_buffer)
+    gst_audio_delay_swap (self);
+
+  /* a new delay is applied once a running crossfade has finished */
+  if (self->fade_pos < self->fade_frames) {
+    GST_OBJECT_UNLOCK (self);
+    return;
+  }
+  delay = self->delay;
+  fade_time = self->fade_time;
+  GST_OBJECT_UNLOCK (self);
+  self->applied_serial = serial;
+
+  gst_audio_delay_set_tap (self, &tap, delay);
+  if (tap.frames == self->tap.frames && tap.frac == self->tap.frac)
+    return;
+
+  if (self->tap.frames == 0 || fade_time == 0) {
+    /* first buffer (or no fading) */
+    self->tap = tap;
+    self->fade_pos = self->fade_frames = 0;
+    return;
+  }
+
+  self->fade_tap = self->tap;
+  self->tap = tap;
+  self->fade_pos = 0;
+  self->fade_frames =
+    gst_util_uint64_scale (fade_time, GST_AUDIO_FILTER_RATE (self),
+			   GST_SECOND);
+}
+
+/* read 'num_frames' frames (delayed by 'tap', relative to the write position
+ * 'wpos') into 'out', handling the wrap-around of the ring buffer
+ */
+static void
+gst_audio_delay_read (GstAudioDelay * self, const GstAudioDelayTap * tap,
+		      guint wpos, guint8 * out, guint num_frames)
+{
+  guint bpf = GST_AUDIO_FILTER_BPF (self);
+  guint channels = GST_AUDIO_FILTER_CHANNELS (self);
+  guint size = self->buffer_size_frames;
+  guint8 *buffer = self->buffer;
+  guint rpos = wpos + size - tap->frames;
+  gdouble frac = tap->frac;
+
+  if (rpos >= size)
+    rpos -= size;
+
+  if (frac <= 0.0) {
+    /* whole number of frames: straight copies */
+    guint n = MIN (num_frames, size - rpos);
+
+    memcpy (out, buffer + rpos * bpf, n * bpf);
+    if (num_frames > n)
+      memcpy (out + n * bpf, buffer, (num_frames - n) * bpf);
+    return;
+  }
+
+  while (num_frames) {
+    /* frames whose both taps are contiguous in the ring buffer */
+    guint n = MIN (num_frames, size - 1 - rpos);
+
+    if (n) {
+      self->interpolate (buffer + rpos * bpf, buffer + (rpos + 1) * bpf,
+			 out, n * channels, frac);
+    } else {
+      /* the last frame of the ring buffer interpolates with the first one */
+      n = 1;
+      self->interpolate (buffer + rpos * bpf, buffer, out, channels, frac);
+    }
+    out += n * bpf;
+    num_frames -= n;
+    rpos += n;
+    if (rpos >= size)
+      rpos -= size;
+  }
+}
+
+/* process a block of (interleaved) frames in place.
+ * the ring buffer is handled in contiguous spans (up to a block, and up to
+ * the wrap-around of the ring buffer):
+ * - read the delayed frames of a span into the scratch buffer
+ *   (while crossfading, read both delays and mix them)
+ * - write the input frames of the span into the ring buffer
+ * - copy the delayed frames to the output
+ * if the delay is shorter than the span, the input is written into the ring
+ * buffer before reading the delayed frames (which then include the input).
+ */
+static void
+gst_audio_delay_process (GstAudioDelay * self, guint8 * data,
+			 guint num_frames)
+{
+  guint bpf = GST_AUDIO_FILTER_BPF (self);
+  guint channels = GST_AUDIO_FILTER_CHANNELS (self);
+  guint size = self->buffer_size_frames;
+  guint8 *fade = self->scratch + self->scratch_frames * bpf;
+
+  while (num_frames) {
+    guint wpos = self->buffer_pos;
+    guint n = MIN (MIN (num_frames, self->scratch_frames), size - wpos);
+    gboolean fading = self->fade_pos < self->fade_frames;
+    guint before = gst_audio_delay_span_before (&self->tap);
+    guint after = gst_audio_delay_span_after (&self->tap, size);
+    gboolean write_first;
+
+    if (fading) {
+      before = MIN (before, gst_audio_delay_span_before (&self->fade_tap));
+      after = MIN (after, gst_audio_delay_span_after (&self->fade_tap, size));
+      n = MIN (n, self->fade_frames - self->fade_pos);
+    }
+    write_first = after > before;
+    n = MIN (n, MAX (MAX (before, after), 1));
+
+    if (write_first)
+      memcpy (self->buffer + wpos * bpf, data, n * bpf);
+    if (fading) {
+      gst_audio_delay_read (self, &self->fade_tap, wpos, self->scratch, n);
+      gst_audio_delay_read (self, &self->tap, wpos, fade, n);
+      self->mix (self->scratch, fade, self->scratch, n, channels,
+		 ((gdouble) self->fade_pos) / self->fade_frames,
+		 1.0 / self->fade_frames);
+      self->fade_pos += n;
+    } else {
+      gst_audio_delay_read (self, &self->tap, wpos, self->scratch, n);
+    }
+    if (!write_first)
+      memcpy (self->buffer + wpos * bpf, data, n * bpf);
+    memcpy (data, self->scratch, n * bpf);
+
+    data += n * bpf;
+    num_frames -= n;
+    wpos += n;
+    self->buffer_pos = (wpos < size) ? wpos : 0;
+  }
+}
 
 /* GstBaseTransform vmethod implementations */
 static GstFlowReturn
 gst_audio_delay_transform_ip (GstBaseTransform * base, GstBuffer * buf)
 {
   GstAudioDelay *self = GST_AUDIO_DELAY (base);
-  guint num_samples;
+  guint num_frames;
   GstClockTime timestamp, stream_time;
   GstMapInfo map;
 
-  g_mutex_lock (&self->lock);
   timestamp = GST_BUFFER_TIMESTAMP (buf);
   stream_time =
     gst_segment_to_stream_time (&base->segment, GST_FORMAT_TIME, timestamp);
@@ -338,35 +754,19 @@ gst_audio_delay_transform_ip (GstBaseTransform * base, GstBuffer * buf)
   if (GST_CLOCK_TIME_IS_VALID (stream_time))
     gst_object_sync_values (GST_OBJECT (self), stream_time);
 
-  if (self->buffer == NULL) {
-    guint bpf, rate;
-
-    bpf = GST_AUDIO_FILTER_BPF (self);
-    rate = GST_AUDIO_FILTER_RATE (self);
-
-    self->delay_frames =
-      MAX (gst_util_uint64_scale (self->delay, rate, GST_SECOND), 1);
-    self->buffer_size_frames =
-      MAX (gst_util_uint64_scale (self->max_delay, rate, GST_SECOND), 1);
-
-    self->buffer_size = self->buffer_size_frames * bpf;
-    self->buffer = g_try_malloc0 (self->buffer_size);
-    self->buffer_pos = 0;
-
-    if (self->buffer == NULL) {
-      g_mutex_unlock (&self->lock);
-      GST_ERROR_OBJECT (self, "Failed to allocate %u bytes", self->buffer_size);
-      return GST_FLOW_ERROR;
-    }
+  if (G_UNLIKELY (self->buffer == NULL)) {
+    GST_ELEMENT_ERROR (self, CORE, NEGOTIATION, (NULL), ("not negotiated"));
+    return GST_FLOW_NOT_NEGOTIATED;
   }
 
+  gst_audio_delay_update (self);
+
   gst_buffer_map (buf, &map, GST_MAP_READWRITE);
-  num_samples = map.size / GST_AUDIO_FILTER_BPS (self);
+  num_frames = map.size / GST_AUDIO_FILTER_BPF (self);
 
-  self->process (self, map.data, num_samples);
+  gst_audio_delay_process (self, map.data, num_frames);
 
   gst_buffer_unmap (buf, &map);
-  g_mutex_unlock (&self->lock);
 
   return GST_FLOW_OK;
 }
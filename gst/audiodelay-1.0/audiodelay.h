@@ -37,7 +37,18 @@ G_BEGIN_DECLS
 typedef struct _GstAudioDelay GstAudioDelay;
 typedef struct _GstAudioDelayClass GstAudioDelayClass;
 
-typedef void (*GstAudioDelayProcessFunc) (GstAudioDelay *, guint8 *, guint);
+typedef void (*GstAudioDelayInterpolateFunc) (const guint8 *, const guint8 *,
+					      guint8 *, guint, gdouble);
+typedef void (*GstAudioDelayMixFunc) (const guint8 *, const guint8 *,
+				      guint8 *, guint, guint, gdouble,
+				      gdouble);
+
+/* a read position in the ring buffer, relative to the write position */
+typedef struct
+{
+  guint frames;
+  gdouble frac;
+} GstAudioDelayTap;
 
 struct _GstAudioDelay
 {
@@ -45,16 +56,34 @@ struct _GstAudioDelay
 
   guint64 delay;
   guint64 max_delay;
+  guint64 fade_time;
 
   /* < private > */
-  GstAudioDelayProcessFunc process;
-  guint delay_frames;
+  GstAudioDelayInterpolateFunc interpolate;
+  GstAudioDelayMixFunc mix;
+
+  /* incremented whenever the delay is changed */
+  gint delay_serial;
+  gint applied_serial;
+
+  GstAudioDelayTap tap;
+  GstAudioDelayTap fade_tap;
+  guint fade_pos;
+  guint fade_frames;
+
   guint8 *buffer;
   guint buffer_pos;
   guint buffer_size;
   guint buffer_size_frames;
+  guint8 *scratch;
+  guint scratch_frames;
 
-  GMutex lock;
+  /* a larger ring buffer, waiting to be swapped in */
+  guint8 *pending_buffer;
+  guint pending_frames;
+  guint pending_bpf;
+  /* the previous ring buffer, waiting to be freed */
+  guint8 *retired_buffer;
 };
 
 struct _GstAudioDelayClass
@@ -0,0 +1,355 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# headless throughput benchmark for the shipped pipelines
+#
+# each pipeline (.gst file) is run for a fixed duration with all hardware
+# sources and sinks (JACK, X11, cameras) replaced by test-sources and
+# fakesinks. the results are reported as JSON:
+# - fps: sustained framerate at the output of the video encoder(s)
+# - cpu: CPU-time of the entire process and of each encoder thread
+# - dropped: number of buffers dropped by the sinks (as reported via QoS)
+# - latency: end-to-end latency (capture -> sink) in milliseconds
+# - trace: (with '--trace') per element, per queue and per branch statistics
+#
+# usage: python -m striem.core.benchmark [-d SECONDS] [FILE.gst ...]
+
+import os
+import re
+import glob
+import json
+import resource
+import threading
+import logging
+
+from . import pipeline
+from . import renditions
+from . import outputs
+from . import sources
+from .pipeline import Gst, GLib
+from .instrument import latencyprobe
+
+log = logging.getLogger(__name__)
+
+pipelinedir = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'pipelines')
+
+
+def _strip(*props):
+    """returns a replacement removing 'props' from the matched element"""
+    pattern = re.compile(r'\s*\b(%s)=\S+' % ('|'.join(props),))
+    return lambda match: pattern.sub('', match.group(0))
+
+
+# replace hardware sources/sinks with something that runs on any machine
+_headless = [
+    # properties that only make sense for the replaced elements
+    (r'\b(jackaudiosrc|jackaudiosink)\b[^!\n]*',
+     _strip('connect', 'client-name')),
+    (r'\b(v4l2src|decklinkvideosrc|alsasink|pulsesink|xvimagesink)\b[^!\n]*',
+     _strip('device')),
+    (r'\bjackaudiosrc\b', 'audiotestsrc is-live=true wave=pink-noise'),
+    (r'\b(jackaudiosink|autoaudiosink|alsasink|pulsesink)\b',
+     'fakesink sync=true'),
+    (r'\b(xvimagesink|ximagesink|autovideosink)\b',
+     'fakesink sync=true qos=true'),
+    (r'\b(v4l2src|decklinkvideosrc)\b', 'videotestsrc'),
+    (r'\bvideotestsrc\b', 'videotestsrc is-live=true'),
+    (r'\b(rtmp2?sink\b[^!\n]*?)\s*\blocation=\S+', r'\1'),
+    (r'\brtmp2?sink\b', 'fakesink sync=false'),
+    (r'\b(filesink\b[^!\n]*?)\s*\blocation=\S+', r'\1'),
+    (r'\bfilesink\b', 'fakesink sync=false'),
+]
+
+
+def headless(pipestring):
+    """replaces all hardware sources/sinks in 'pipestring' with fakes"""
+    for (pattern, replacement) in _headless:
+        pipestring = re.sub(pattern, replacement, pipestring)
+    return pipestring
+
+
+def _threadtimes():
+    """
+    returns a {tid: (threadname, cputime)} dictionary
+    for all threads of this process (Linux only)
+    """
+    times = dict()
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    try:
+        tids = os.listdir('/proc/self/task')
+    except OSError:
+        return times
+    for tid in tids:
+        try:
+            with open('/proc/self/task/%s/stat' % (tid,), 'r') as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # the threadname is in parentheses (and might contain spaces)
+        name = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        # fields[11] is 'utime', fields[12] is 'stime'
+        times[int(tid)] = (name, (int(fields[11]) + int(fields[12])) / ticks)
+    return times
+
+
+def _processtime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _klass(lmn):
+    factory = lmn.get_factory()
+    if not factory:
+        return ""
+    return factory.get_metadata('klass') or ""
+
+
+class _padcounter:
+    """counts the buffers (and bytes) passing through a pad"""
+    def __init__(self, pad):
+        self.buffers = 0
+        self.bytes = 0
+        pad.add_probe(Gst.PadProbeType.BUFFER, self._probe)
+
+    def _probe(self, pad, info):
+        buf = info.get_buffer()
+        self.buffers += 1
+        self.bytes += buf.get_size()
+        return Gst.PadProbeReturn.OK
+
+    def reset(self):
+        self.buffers = 0
+        self.bytes = 0
+
+
+class _threadspy:
+    """remembers the (native) id of the streaming thread feeding a pad"""
+    def __init__(self, pad):
+        self.tid = None
+        self.probe = pad.add_probe(Gst.PadProbeType.BUFFER, self._probe)
+
+    def _probe(self, pad, info):
+        getid = getattr(threading, 'get_native_id', None)
+        if getid:
+            self.tid = getid()
+        return Gst.PadProbeReturn.REMOVE
+
+
+class benchmark:
+    def __init__(self, filename, config=dict(), duration=10., warmup=2.,
+                 trace=False):
+        self.filename = filename
+        self.duration = duration
+        self.warmup = warmup
+        self.error = None
+        self.loop = None
+        self.dropped = dict()
+        self.encoders = dict()
+        self.sinks = dict()
+        self.threads = dict()
+        self.cpu0 = None
+        self.dropped0 = 0
+
+        pipestring = headless(pipeline._pipeRead(filename, config))
+        self.pip = pipeline.pipeline(filename, config, pipestring=pipestring,
+                                     instrument=trace)
+        self.pip.setEventHandlers({
+            Gst.MessageType.QOS: self._qos,
+            Gst.MessageType.ERROR: self._error,
+        })
+
+        for lmn in self.pip.pipeline.iterate_recurse():
+            klass = _klass(lmn)
+            name = lmn.get_name()
+            if "Encoder" in klass:
+                sink = lmn.get_static_pad("sink")
+                src = lmn.get_static_pad("src")
+                if sink and src:
+                    self.encoders[name] = (_padcounter(src),
+                                           _threadspy(sink),
+                                           "Video" in klass)
+            elif "Sink" in klass:
+                sink = lmn.get_static_pad("sink")
+                if sink:
+                    self.sinks[name] = latencyprobe(sink, self.pip.pipeline)
+
+    def _qos(self, bus, message):
+        # the QoS-stats are cumulative per element
+        (fmt, processed, dropped) = message.parse_qos_stats()
+        self.dropped[message.src.get_name()] = dropped
+
+    def _error(self, bus, message):
+        (err, debug) = message.parse_error()
+        log.error("%s: %s" % (message.src.get_name(), err.message))
+        self.error = err.message
+        if self.loop:
+            self.loop.quit()
+
+    def _start(self):
+        # called after the warmup phase
+        for (counter, _, _) in self.encoders.values():
+            counter.reset()
+        for probe in self.sinks.values():
+            probe.reset()
+        self.pip.stats(reset=True)
+        self.dropped0 = sum(self.dropped.values())
+        self.cpu0 = _processtime()
+        self.threads = _threadtimes()
+        GLib.timeout_add(int(self.duration * 1000), self.loop.quit)
+        return False
+
+    def _framerate(self, encoder):
+        lmn = self.pip.pipeline.get_by_name(encoder)
+        caps = lmn.get_static_pad("sink").get_current_caps()
+        if not caps:
+            return None
+        (ok, num, denom) = caps.get_structure(0).get_fraction('framerate')
+        if not ok or not denom:
+            return None
+        return float(num) / denom
+
+    def _encodertime(self, tid, threads):
+        # threads spawned by an encoder (e.g. x264's worker threads)
+        # inherit the name of the streaming thread
+        if tid not in threads:
+            return None
+        name = threads[tid][0]
+        t0 = sum([t for (n, t) in self.threads.values() if n == name])
+        t1 = sum([t for (n, t) in threads.values() if n == name])
+        return t1 - t0
+
+    def run(self):
+        self.loop = GLib.MainLoop()
+        self.pip.run(True)
+        GLib.timeout_add(int(self.warmup * 1000), self._start)
+        self.loop.run()
+        threads = _threadtimes()
+        trace = self.pip.stats()
+        cpu = None
+        if self.cpu0 is not None:
+            cpu = _processtime() - self.cpu0
+        self.pip.pipeline.set_state(Gst.State.NULL)
+        self.pip.dispatcher.stop()
+
+        result = dict()
+        result['pipeline'] = self.filename
+        result['duration'] = self.duration
+        if self.error:
+            result['error'] = self.error
+            return result
+
+        result['encoders'] = dict()
+        result['fps'] = None
+        result['nominal_fps'] = None
+        for name, (counter, spy, isvideo) in self.encoders.items():
+            enc = dict()
+            enc['buffers'] = counter.buffers
+            enc['kbps'] = counter.bytes * 8. / 1000. / self.duration
+            enc['cpu'] = self._encodertime(spy.tid, threads)
+            result['encoders'][name] = enc
+            if isvideo and result['fps'] is None:
+                result['fps'] = counter.buffers / self.duration
+                result['nominal_fps'] = self._framerate(name)
+        if result['fps'] is not None and result['nominal_fps']:
+            result['realtime'] = result['fps'] >= 0.95 * result['nominal_fps']
+        result['cpu'] = cpu
+        result['dropped'] = sum(self.dropped.values()) - self.dropped0
+
+        latency = dict()
+        for name, probe in self.sinks.items():
+            if not probe.count:
+                continue
+            latency[name] = {
+                'mean': probe.total / probe.count / float(Gst.MSECOND),
+                'max': probe.max / float(Gst.MSECOND),
+            }
+        result['latency'] = latency
+        if trace:
+            result['trace'] = trace
+        return result
+
+
+def run(filenames, config=dict(), duration=10., warmup=2., trace=False):
+    """benchmarks all 'filenames', returning a list of results"""
+    results = []
+    for filename in filenames:
+        log.info("benchmarking %s" % (filename,))
+        try:
+            bench = benchmark(filename, config, duration, warmup, trace)
+            results += [bench.run()]
+        except GLib.Error as e:
+            results += [{'pipeline': filename, 'error': str(e)}]
+    return results
+
+
+# ####################################################################
+if __name__ == '__main__':
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--duration', type=float, default=10.,
+                        help="measuring time per pipeline (in seconds)")
+    parser.add_argument('-w', '--warmup', type=float, default=2.,
+                        help="time to settle before measuring (in seconds)")
+    parser.add_argument('-o', '--output', type=str,
+                        help="write the JSON results to this file")
+    parser.add_argument('--set', type=str,
+                        nargs=2, metavar=('KEY', 'value'),
+                        action='append',
+                        help="replace @KEY@ in the pipelines with 'value'")
+    parser.add_argument('-r', '--rendition', type=str,
+                        nargs=3, metavar=('NAME', 'WIDTHxHEIGHT', 'KBPS'),
+                        action='append',
+                        help="add a rendition (replacing @RENDITIONS@)")
+    parser.add_argument('-t', '--trace', action='store_true',
+                        help="include per element statistics (slower)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="raise verbosity")
+    parser.add_argument('pipelines', nargs='*',
+                        help="pipeline files (default: all shipped *.gst)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN - 10 * args.verbose)
+    filenames = args.pipelines
+    if not filenames:
+        filenames = sorted(glob.glob(os.path.join(pipelinedir, '*.gst')))
+    config = dict()
+    for (key, value) in args.set or []:
+        config[key.upper()] = value
+    (config['SOURCES'], _) = sources.sources([('test', {})])
+    (config['OUTPUTS'], _, _) = outputs.outputs([('stream', {})])
+    ladder = []
+    for (name, size, bitrate) in args.rendition or []:
+        (width, _, height) = size.partition('x')
+        ladder += [(name, {'width': width, 'height': height,
+                           'bitrate': bitrate})]
+    if ladder:
+        (config['RENDITIONS'], _, _, _) = renditions.ladder(ladder)
+
+    results = run(filenames, config, args.duration, args.warmup, args.trace)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print("")
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# adaptive bitrate
+#
+# the backlog of the output branches (the fill level of their queues, and
+# of the netsink backlogs) is sampled periodically.
+# if the uplink cannot keep up (the backlog stays above 'high' for a few
+# samples), the encoder's bitrate is lowered multiplicatively; once the
+# backlog has stayed below 'low' for a longer while, the bitrate is raised
+# again in small steps (up to the maximum).
+# the two thresholds and the different hold times form the hysteresis,
+# so the bitrate does not oscillate.
+# all decisions are kept in 'history' (and logged, and appended as JSON
+# lines to 'logfile' for later inspection).
+
+import time
+import json
+import collections
+import logging
+
+from gi.repository import GLib
+
+log = logging.getLogger(__name__)
+
+
+def queuefill(queue):
+    """returns a function to get the fill level (0..1) of a queue"""
+    def fill():
+        levels = []
+        for (cur, limit) in [('current-level-time', 'max-size-time'),
+                             ('current-level-bytes', 'max-size-bytes'),
+                             ('current-level-buffers', 'max-size-buffers')]:
+            maxi = queue.get_property(limit)
+            if maxi:
+                levels += [queue.get_property(cur) / float(maxi)]
+        return max(levels or [0.])
+    return fill
+
+
+def backlogfill(netsink):
+    """returns a function to get the fill level (0..1) of a netsink"""
+    def fill():
+        backlog = netsink.backlog
+        if not backlog.maxbytes:
+            return 0.
+        return min(backlog.bytes / float(backlog.maxbytes), 1.)
+    return fill
+
+
+class controller:
+    def __init__(self, encoder, sources, minimum, maximum,
+                 interval=1., low=0.1, high=0.5,
+                 downafter=2, upafter=10,
+                 decrease=0.75, increase=0.1,
+                 historysize=1000, logfile=None):
+        """
+        adapts the 'bitrate' of the 'encoder' element (in kbit/s)
+        between 'minimum' and 'maximum'.
+        'sources' is a list of functions returning the current fill level
+        (0..1) of the output branches (see queuefill(), backlogfill()).
+        the fill level is sampled every 'interval' seconds:
+        - if it is above 'high' for 'downafter' samples in a row, the
+          bitrate is multiplied by 'decrease'
+        - if it is below 'low' for 'upafter' samples in a row, the
+          bitrate is raised by 'increase' * maximum
+        each decision is appended to 'logfile' (if given).
+        """
+        self.encoder = encoder
+        self.sources = sources
+        self.minimum = int(minimum)
+        self.maximum = int(maximum)
+        self.low = low
+        self.high = high
+        self.downafter = downafter
+        self.upafter = upafter
+        self.decrease = decrease
+        self.increase = increase
+        self.history = collections.deque(maxlen=historysize)
+        self.logfile = logfile
+        self.above = 0
+        self.below = 0
+        self.bitrate = self._clip(encoder.get_property('bitrate'))
+        self._set(self.bitrate, 0., "initial")
+        self.timer = GLib.timeout_add(int(interval * 1000), self._sample)
+
+    def _clip(self, bitrate):
+        return int(max(self.minimum, min(self.maximum, bitrate)))
+
+    def _set(self, bitrate, fill, reason):
+        old = self.encoder.get_property('bitrate')
+        decision = {
+            'time': time.time(),
+            'fill': fill,
+            'from': old,
+            'to': bitrate,
+            'reason': reason,
+        }
+        self.history.append(decision)
+        if self.logfile:
+            try:
+                with open(self.logfile, 'a') as f:
+                    f.write(json.dumps(decision) + "\n")
+            except IOError:
+                log.exception("cannot write to '%s'" % (self.logfile,))
+        log.info("%s: bitrate %s -> %s (%s, fill=%.2f)"
+                 % (self.encoder.get_name(), old, bitrate, reason, fill))
+        if bitrate != old:
+            self.encoder.set_property('bitrate', bitrate)
+        self.bitrate = bitrate
+
+    def fill(self):
+        return max([fun() for fun in self.sources] or [0.])
+
+    def _sample(self):
+        fill = self.fill()
+        if fill > self.high:
+            self.above += 1
+            self.below = 0
+        elif fill < self.low:
+            self.below += 1
+            self.above = 0
+        else:
+            self.above = 0
+            self.below = 0
+
+        if self.above >= self.downafter:
+            self.above = 0
+            bitrate = self._clip(self.bitrate * self.decrease)
+            if bitrate != self.bitrate:
+                self._set(bitrate, fill, "congested")
+        elif self.below >= self.upafter:
+            self.below = 0
+            bitrate = self._clip(self.bitrate + self.increase * self.maximum)
+            if bitrate != self.bitrate:
+                self._set(bitrate, fill, "recovered")
+        return True
+
+    def stats(self):
+        return {
+            'bitrate': self.bitrate,
+            'fill': self.fill(),
+            'history': list(self.history),
+        }
+
+    def stop(self):
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
@@ -27,6 +27,15 @@ except ImportError:
 import logging
 log = logging.getLogger(__name__)
 
+
+def _tobool(value):
+    # numbers, or true/yes/on
+    try:
+        return bool(int(float(value)))
+    except ValueError:
+        return str(value).lower() in ['true', 'yes', 'on']
+
+
 # files listed LATER can overwrite values from earlier files
 _configpaths = [
     # built-in
@@ -45,9 +54,22 @@ _configpaths = [
 
 # section: stream
 # - (string)URL
+# - (bool)instrument: collect per element statistics (see pipeline.stats())
+# - (float)queuereport: interval (in seconds) for reporting the queue fill
+#   levels (see pipeline.reportQueues()), 0 to disable
+# - (float)muxqueue: capacity (in seconds) of the queues in front of the
+#   muxer, which bounds the A/V delay (see pipelines/README.txt)
+
+# section: GUI
+# - (bool)allowquit
+# - (int)preview.width, (int)preview.height, (int)preview.fps:
+#   size and framerate of the preview (the preview is scaled down and
+#   rate-limited early, and never holds back the stream)
+# - (float)meter.interval: interval (in seconds) of the audio meter updates
+#   (the 'level' element's own interval is set in the pipeline)
 
 # section: video
-# - (string)source
+# - (string)source: name of the initially selected [source.NAME]
 
 # section: audio
 # - (string)source
@@ -63,6 +85,39 @@ _configpaths = [
 # - (string)<KEY>
 # replaces all @KEY@ in the pipeline with the corresponding <VALUE>
 
+# section: bitrate (adaptive bitrate, see bitrate.py)
+# - (int)min, (int)max: bounds of the encoder's bitrate (kbit/s)
+# - (string)encoder: name of the encoder element (default: venc)
+# - (string)log: file to append the decisions to
+
+# section: replay (instant replay, see replay.py)
+# - (string)file: the ring file (no replay if empty)
+# - (float)length: time (in seconds) kept in the ring
+# - (float)size: size (in MB) of the ring file
+
+# section: record (segmented recording, see recorder.py)
+# - (float)segment: length (in seconds) of the segments
+# - (string)muxer: e.g. mp4mux, matroskamux
+
+# sections: queue.PATTERN
+# - properties (e.g. max-size-time, max-size-bytes, max-size-buffers, leaky,
+#   min-threshold-time) applied to all queues whose name matches PATTERN
+#   (shell-style wildcards, see pipeline.setQueuePolicy())
+
+# sections: source.NAME (see sources.py)
+# - (string)pipeline: description of the (live) video source
+
+# sections: output.NAME (see outputs.py)
+# - (string)url
+# - (bool)enabled
+# - (float)buffer (seconds)
+
+# sections: rendition.NAME (see renditions.py)
+# - (int)width, (int)height
+# - (int)bitrate (kbit/s)
+# - (string)url
+# - the options of the outputs (enabled, buffer, reconnect, backlog)
+
 
 class configuration:
     _typefuns = {
@@ -75,6 +130,18 @@ class configuration:
         'text.X': float,
         'text.Y': float,
         'text.decoration': (lambda v: bool(int(float(v)))),
+        'instrument': (lambda v: _tobool(v or 0)),
+        'queuereport': (lambda v: float(v or 0)),
+        'muxqueue': (lambda v: float(v or 0)),
+        'preview.width': (lambda v: int(float(v))),
+        'preview.height': (lambda v: int(float(v))),
+        'preview.fps': (lambda v: int(float(v))),
+        'meter.interval': (lambda v: float(v or 0)),
+        'length': (lambda v: float(v or 0)),
+        'segment': (lambda v: float(v or 0)),
+        'size': (lambda v: float(v or 0)),
+        'min': (lambda v: int(float(v))),
+        'max': (lambda v: int(float(v))),
     }
 
     def __init__(self, filename=None, defaultvalues={}):
@@ -140,6 +207,10 @@ class configuration:
             return configuration._typefuns[option](v)
         return v
 
+    def sections(self, prefix=""):
+        """returns the names of all sections starting with 'prefix'"""
+        return [s for s in self._cfg.sections() if s.startswith(prefix)]
+
     def getSectionDict(self, section):
         d=dict()
         if not self._cfg.has_section(section):
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# bus dispatcher
+#
+# the messages of a bus are dispatched in a thread of their own (running a
+# GLib main loop with its own main context), so a busy GUI (e.g. a modal
+# file dialog) never delays the handling of EOS, errors or QoS.
+#
+# handlers subscribe to (message type, source element name, structure name);
+# each of them can be None (matching anything), so dispatching a message is
+# a few dictionary lookups (independent of the number of subscriptions).
+# handlers are called as fun(bus, message), in the dispatcher thread;
+# handlers that touch widgets must subscribe with gui=True: they are called
+# in the main loop of the default context instead (which is the GUI thread).
+
+import threading
+import logging
+
+from gi.repository import GLib
+from gi.repository import Gst
+
+log = logging.getLogger(__name__)
+
+
+def _key(msgtype=None, source=None, name=None):
+    return (msgtype, source, name)
+
+
+def _wildcards(value):
+    # the keys matching 'value'
+    if value is None:
+        return (None,)
+    return (value, None)
+
+
+class subscription:
+    def __init__(self, fun, key, gui=False):
+        self.fun = fun
+        self.key = key
+        self.gui = gui
+
+    def __repr__(self):
+        return "subscription(%s, %s)" % (self.key, self.fun)
+
+
+class dispatcher:
+    def __init__(self, bus, fallback=None, name="bus"):
+        """
+        dispatches the messages of 'bus' (in a new thread);
+        messages without any subscriber are passed to
+        fallback(bus, message) (if given)
+        """
+        self.bus = bus
+        self.fallback = None
+        if fallback:
+            self.fallback = subscription(fallback, None)
+        self.lock = threading.Lock()
+        self.subscriptions = dict()
+        self.context = GLib.MainContext()
+        self.loop = GLib.MainLoop(self.context)
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+        self.ready.wait()
+
+    def _run(self):
+        self.context.push_thread_default()
+        # the watch is attached to the thread-default main context
+        self.bus.add_watch(GLib.PRIORITY_DEFAULT, self._dispatch, None)
+        self.ready.set()
+        self.loop.run()
+        self.bus.remove_watch()
+        self.context.pop_thread_default()
+
+    def subscribe(self, fun, msgtype=None, source=None, name=None,
+                  gui=False):
+        """
+        calls fun(bus, message) for all messages of type 'msgtype',
+        posted by the element named 'source', with a structure named 'name'
+        (None matches anything).
+        if 'gui' is True, 'fun' is called in the GUI thread.
+        returns a subscription (to be passed to unsubscribe())
+        """
+        sub = subscription(fun, _key(msgtype, source, name), gui)
+        with self.lock:
+            self.subscriptions.setdefault(sub.key, []).append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            subs = self.subscriptions.get(sub.key, [])
+            if sub in subs:
+                subs.remove(sub)
+            if not subs:
+                self.subscriptions.pop(sub.key, None)
+
+    def _lookup(self, message):
+        src = message.src
+        source = src and src.get_name()
+        s = message.get_structure()
+        name = s and s.get_name()
+        subs = []
+        with self.lock:
+            for t in _wildcards(message.type):
+                for e in _wildcards(source):
+                    for n in _wildcards(name):
+                        subs += self.subscriptions.get((t, e, n), [])
+        return subs
+
+    def _dispatch(self, bus, message, data):
+        subs = self._lookup(message)
+        if not subs and self.fallback:
+            subs = [self.fallback]
+        for sub in subs:
+            if sub.gui:
+                GLib.idle_add(self._call, sub.fun, bus, message)
+            else:
+                self._call(sub.fun, bus, message)
+        return True
+
+    def _call(self, fun, bus, message):
+        try:
+            fun(bus, message)
+        except Exception:
+            log.exception("handler %s failed for %s" % (fun, message.type))
+        return False
+
+    def stop(self, timeout=None):
+        """stops dispatching (and waits for the thread to finish)"""
+        self.loop.quit()
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+
+# ####################################################################
+if __name__ == '__main__':
+    Gst.init(None)
+    logging.basicConfig(level=logging.INFO)
+    pipeline = Gst.parse_launch(
+        'audiotestsrc num-buffers=100 ! level name=alevel ! fakesink')
+    d = dispatcher(pipeline.get_bus())
+    loop = GLib.MainLoop()
+
+    def level(bus, message):
+        print("%s: %s" % (threading.current_thread().name,
+                          message.get_structure().get_value('rms')))
+
+    def eos(bus, message):
+        print("%s: EOS" % (threading.current_thread().name,))
+        loop.quit()
+    d.subscribe(level, Gst.MessageType.ELEMENT, "alevel", "level", gui=True)
+    d.subscribe(eos, Gst.MessageType.EOS)
+    pipeline.set_state(Gst.State.PLAYING)
+    loop.run()
+    pipeline.set_state(Gst.State.NULL)
+    d.stop()
@@ -0,0 +1,287 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# instrumentation of a running pipeline
+#
+# attaches pad-probes to all elements of a pipeline and collects
+# - per element processing time
+#   (time between a buffer entering the element and the element pushing
+#    the result, as long as this happens within the same streaming thread)
+# - per queue fill levels (current and peak)
+# - per branch latency
+#   (how late buffers arrive at each sink, in running-time)
+#
+# the queue fill levels can also be reported continuously
+# (as 'queue-level' element messages, see queuereporter)
+
+import time
+import logging
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+from gi.repository import GLib
+from gi.repository import Gst
+
+log = logging.getLogger(__name__)
+
+_now = getattr(time, 'perf_counter', time.time)
+
+
+def _ms(value):
+    return value * 1000.
+
+
+class _elementstats:
+    """processing time of a single element"""
+    def __init__(self, lmn):
+        self.entered = dict()
+        self.reset()
+        for pad in lmn.sinkpads:
+            pad.add_probe(Gst.PadProbeType.BUFFER |
+                          Gst.PadProbeType.BUFFER_LIST, self._enter)
+        for pad in lmn.srcpads:
+            pad.add_probe(Gst.PadProbeType.BUFFER |
+                          Gst.PadProbeType.BUFFER_LIST, self._leave)
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def _enter(self, pad, info):
+        self.entered[get_ident()] = _now()
+        return Gst.PadProbeReturn.OK
+
+    def _leave(self, pad, info):
+        t0 = self.entered.pop(get_ident(), None)
+        if t0 is not None:
+            dt = _now() - t0
+            self.count += 1
+            self.total += dt
+            self.max = max(self.max, dt)
+        return Gst.PadProbeReturn.OK
+
+    def stats(self):
+        if not self.count:
+            return None
+        return {
+            'count': self.count,
+            'mean': _ms(self.total / self.count),
+            'max': _ms(self.max),
+        }
+
+
+class _queuestats:
+    """fill level of a queue (sampled)"""
+    _levels = ['current-level-buffers',
+               'current-level-bytes',
+               'current-level-time']
+
+    def __init__(self, lmn):
+        self.queue = lmn
+        self.reset()
+
+    def reset(self):
+        self.peak = dict([(l, 0) for l in _queuestats._levels])
+
+    def sample(self):
+        current = dict()
+        for l in _queuestats._levels:
+            v = self.queue.get_property(l)
+            current[l] = v
+            self.peak[l] = max(self.peak[l], v)
+        return current
+
+    def stats(self):
+        current = self.sample()
+        return {
+            'buffers': current['current-level-buffers'],
+            'bytes': current['current-level-bytes'],
+            'time': current['current-level-time'] / float(Gst.MSECOND),
+            'peak-buffers': self.peak['current-level-buffers'],
+            'peak-bytes': self.peak['current-level-bytes'],
+            'peak-time': self.peak['current-level-time'] / float(Gst.MSECOND),
+        }
+
+
+class queuereporter:
+    def __init__(self, pipeline, interval=1., sampling=0.1):
+        """
+        samples the fill levels of all queues in 'pipeline' every
+        'sampling' seconds, and posts them every 'interval' seconds
+        as ELEMENT messages (from the queue) with a 'queue-level' field,
+        holding a structure:
+          queue-level, name=NAME, buffers=UINT, bytes=UINT, time=DOUBLE,
+          peak-buffers=UINT, peak-bytes=UINT, peak-time=DOUBLE
+        (times in milliseconds; the peaks are since the last report)
+        """
+        self.queues = dict()
+        for lmn in pipeline.iterate_recurse():
+            factory = lmn.get_factory()
+            if factory and "queue" == factory.get_name():
+                self.queues[lmn.get_name()] = _queuestats(lmn)
+        self.every = max(int(round(interval / sampling)), 1)
+        self.count = 0
+        self.timer = None
+        if self.queues:
+            self.timer = GLib.timeout_add(int(sampling * 1000), self._sample)
+
+    def _sample(self):
+        self.count += 1
+        report = self.count >= self.every
+        for name, q in self.queues.items():
+            if not report:
+                q.sample()
+                continue
+            stats = q.stats()
+            s = Gst.Structure.new_empty("queue-level")
+            s.set_value('name', name)
+            for k, v in stats.items():
+                s.set_value(k, v)
+            msg = Gst.Structure.new_empty("queue-level")
+            msg.set_value('queue-level', s)
+            q.queue.post_message(Gst.Message.new_element(q.queue, msg))
+            q.reset()
+        if report:
+            self.count = 0
+        return True
+
+    def stop(self):
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
+
+
+class latencyprobe:
+    """measures how late buffers arrive at a sink (in running-time)"""
+    def __init__(self, pad, pipeline):
+        self.pipeline = pipeline
+        self.segment = None
+        self.reset()
+        pad.add_probe(Gst.PadProbeType.BUFFER |
+                      Gst.PadProbeType.EVENT_DOWNSTREAM, self._probe)
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _probe(self, pad, info):
+        if info.type & Gst.PadProbeType.EVENT_DOWNSTREAM:
+            event = info.get_event()
+            if event.type == Gst.EventType.SEGMENT:
+                self.segment = event.parse_segment()
+            return Gst.PadProbeReturn.OK
+        buf = info.get_buffer()
+        clock = self.pipeline.get_clock()
+        if not clock or not self.segment:
+            return Gst.PadProbeReturn.OK
+        if buf.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        runtime = self.segment.to_running_time(Gst.Format.TIME, buf.pts)
+        if runtime == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        now = clock.get_time() - self.pipeline.get_base_time()
+        latency = max(now - runtime, 0)
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        return Gst.PadProbeReturn.OK
+
+    def stats(self):
+        if not self.count:
+            return None
+        return {
+            'count': self.count,
+            'mean': self.total / self.count / float(Gst.MSECOND),
+            'max': self.max / float(Gst.MSECOND),
+        }
+
+
+class tracer:
+    def __init__(self, pipeline, interval=0.1):
+        """
+        instrument all elements in 'pipeline'.
+        queue fill levels are sampled every 'interval' seconds
+        (to keep track of their peak values)
+        """
+        self.elements = dict()
+        self.queues = dict()
+        self.branches = dict()
+
+        for lmn in pipeline.iterate_recurse():
+            if isinstance(lmn, Gst.Bin):
+                continue
+            name = lmn.get_name()
+            factory = lmn.get_factory()
+            if factory and "queue" == factory.get_name():
+                # queues decouple threads, so there's no processing time
+                self.queues[name] = _queuestats(lmn)
+                continue
+            if lmn.sinkpads and lmn.srcpads:
+                self.elements[name] = _elementstats(lmn)
+            elif lmn.sinkpads:
+                self.branches[name] = latencyprobe(lmn.sinkpads[0], pipeline)
+
+        self.timer = None
+        if self.queues and interval:
+            self.timer = GLib.timeout_add(int(interval * 1000), self._sample)
+
+    def _sample(self):
+        for q in self.queues.values():
+            q.sample()
+        return True
+
+    def stop(self):
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
+
+    def reset(self):
+        for d in [self.elements, self.queues, self.branches]:
+            for s in d.values():
+                s.reset()
+
+    def stats(self):
+        """
+        returns a dictionary with the collected statistics
+        (all times in milliseconds)
+        {
+          'elements': {NAME: {'count', 'mean', 'max'}},
+          'queues':   {NAME: {'buffers', 'bytes', 'time',
+                              'peak-buffers', 'peak-bytes', 'peak-time'}},
+          'branches': {SINKNAME: {'count', 'mean', 'max'}},
+        }
+        """
+        def collect(d):
+            result = dict()
+            for name, s in d.items():
+                v = s.stats()
+                if v is not None:
+                    result[name] = v
+            return result
+        return {
+            'elements': collect(self.elements),
+            'queues': collect(self.queues),
+            'branches': collect(self.branches),
+        }
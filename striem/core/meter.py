@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# audio metering
+#
+# the messages of a 'level' element are intercepted (by the bus' sync
+# handler, in the streaming thread), and aggregated per channel over all
+# messages since the last update:
+# - peak, decay: the maximum
+# - rms: the mean power
+# (all in dB)
+# they are dropped right there, so they never go through the bus' queue.
+# the element's 'interval' is left as configured (in the pipeline), so any
+# number of messages (or none) may arrive per update.
+# every 'interval' seconds (if there's new data), all subscribers are
+# called (in the main loop) with a single update:
+#   fun({'rms': [...], 'peak': [...], 'decay': [...]})
+# any number of subscribers can be added (see meter.subscribe()), without
+# touching the pipeline.
+
+import math
+import threading
+import logging
+
+from gi.repository import GLib
+from gi.repository import Gst
+
+log = logging.getLogger(__name__)
+
+_defaultinterval = 0.05
+_fields = ('rms', 'peak', 'decay')
+
+
+def _max(a, b):
+    if len(a) != len(b):
+        return b
+    return [max(x, y) for (x, y) in zip(a, b)]
+
+
+def _db(power):
+    if power <= 0:
+        return -float('inf')
+    return 10 * math.log10(power)
+
+
+class meter:
+    def __init__(self, lmn, interval=None):
+        """
+        meters the 'level' element 'lmn' (updating the subscribers every
+        'interval' seconds)
+        """
+        self.element = lmn
+        self.interval = float(interval or _defaultinterval)
+        self.lock = threading.Lock()
+        self.values = dict()
+        # the aggregation since the last update
+        self.peak = None
+        self.decay = None
+        self.power = None
+        self.count = 0
+        self.subscribers = []
+        lmn.set_property('post-messages', True)
+        self.timer = GLib.timeout_add(int(self.interval * 1000),
+                                      self._update)
+
+    def handleMessage(self, message):
+        """
+        to be called (from the bus' sync handler) with the ELEMENT messages;
+        returns True if the message has been consumed
+        """
+        if message.src != self.element:
+            return False
+        s = message.get_structure()
+        if not s or "level" != s.get_name():
+            return False
+        values = dict()
+        for f in _fields:
+            if s.has_field(f):
+                values[f] = list(s.get_value(f))
+        rms = values.get('rms', [])
+        power = [10 ** (x / 10.) for x in rms]
+        with self.lock:
+            if self.count and len(self.power) != len(power):
+                # the number of channels changed
+                self.count = 0
+            if not self.count:
+                self.peak = values.get('peak', [])
+                self.decay = values.get('decay', [])
+                self.power = power
+            else:
+                self.peak = _max(self.peak, values.get('peak', []))
+                self.decay = _max(self.decay, values.get('decay', []))
+                self.power = [a + b for (a, b) in zip(self.power, power)]
+            self.count += 1
+        return True
+
+    def levels(self):
+        """returns the latest levels (e.g. for polling)"""
+        with self.lock:
+            return dict(self.values)
+
+    def subscribe(self, fun):
+        """calls fun(levels) for each update"""
+        if fun not in self.subscribers:
+            self.subscribers.append(fun)
+        return fun
+
+    def unsubscribe(self, fun):
+        try:
+            self.subscribers.remove(fun)
+        except ValueError:
+            pass
+
+    def _update(self):
+        with self.lock:
+            if not self.count:
+                return True
+            levels = {
+                'peak': self.peak,
+                'decay': self.decay,
+                'rms': [_db(p / self.count) for p in self.power],
+            }
+            self.count = 0
+            self.values = levels
+        for fun in list(self.subscribers):
+            try:
+                fun(levels)
+            except Exception:
+                log.exception("meter subscriber %s failed" % (fun,))
+        return True
+
+    def stop(self):
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
+
+
+# ####################################################################
+if __name__ == '__main__':
+    Gst.init(None)
+    logging.basicConfig(level=logging.INFO)
+    pipeline = Gst.parse_launch(
+        'audiotestsrc is-live=true wave=pink-noise'
+        ' ! level name=alevel ! fakesink')
+    m = meter(pipeline.get_by_name('alevel'), 0.1)
+
+    def sync(bus, message, data):
+        if m.handleMessage(message):
+            return Gst.BusSyncReply.DROP
+        return Gst.BusSyncReply.PASS
+
+    def show(levels):
+        print("peak: %s" % (["%.1f" % x for x in levels.get('peak', [])],))
+    pipeline.get_bus().set_sync_handler(sync, None)
+    m.subscribe(show)
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        GLib.MainLoop().run()
+    except KeyboardInterrupt:
+        pass
+    pipeline.set_state(Gst.State.NULL)
@@ -0,0 +1,372 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# auto-reconnecting network output
+#
+# the main pipeline ends in an 'appsink'; the data is handed over to a
+# separate sender pipeline ('appsrc ! rtmpsink'), so a network error only
+# takes down the sender, never the main pipeline.
+# the sender is restarted (with increasing back-off) until it succeeds;
+# a connection only counts as established once the sink has actually
+# rendered (sent) data (e.g. rtmpsink only connects when rendering the
+# first buffer).
+#
+# while disconnected (or while the network is too slow), the encoded data
+# is kept in a bounded backlog of GOPs: a (re)connection always starts at a
+# keyframe, and under pressure the oldest unsent GOPs are dropped first.
+# the stream headers (FLV header, metadata and codec configuration, flagged
+# HEADER) are kept aside, and sent first on each (re)connection.
+#
+# the state is reported as ELEMENT messages (from the appsink) on the bus
+# of the main pipeline, with a 'netsink' field holding a structure:
+#   netsink, name=NAME, connected=BOOL, reconnects=INT,
+#   disconnected=DOUBLE (seconds), dropped-bytes=UINT64,
+#   backlog-bytes=UINT64
+# (use pipeline.setEventKeys({'netsink': fun}) to receive them)
+
+import time
+import threading
+import collections
+import logging
+
+from gi.repository import GLib
+from gi.repository import Gst
+
+log = logging.getLogger(__name__)
+
+# back-off (in seconds) between reconnection attempts
+_minretry = 0.5
+_maxretry = 10.
+# default size of the backlog (in bytes)
+_defaultbacklog = 16 * 1024 * 1024
+# data queued in the sender (anything beyond is kept in the backlog)
+_senderbytes = 512 * 1024
+# interval (in seconds) for status messages while disconnected
+_statusinterval = 1.
+
+
+def _sender(url):
+    """returns the pipeline description of the sender for 'url'"""
+    desc = "appsrc name=src is-live=true format=time ! "
+    if url.startswith("tcp://"):
+        (host, _, port) = url[len("tcp://"):].partition(':')
+        return desc + "tcpclientsink name=sink host=%s port=%s sync=false" % (
+            host, port or 1935)
+    return desc + "rtmpsink name=sink location=%s sync=false" % (url,)
+
+
+class _gop:
+    def __init__(self):
+        # a GOP always starts with a keyframe
+        self.buffers = collections.deque()
+        self.bytes = 0
+        self.sent = 0
+
+
+class backlog:
+    """encoded buffers, organized in GOPs"""
+    def __init__(self, maxbytes=_defaultbacklog):
+        self.maxbytes = maxbytes
+        self.gops = collections.deque()
+        self.bytes = 0
+        self.dropped = 0
+        self.headers = []
+        self.inheaders = False
+        # headers still to be sent (before any GOP)
+        self.pending = collections.deque()
+
+    def __len__(self):
+        return len(self.gops)
+
+    def add(self, buf):
+        if buf.has_flags(Gst.BufferFlags.HEADER):
+            # a new set of headers replaces the old one
+            if not self.inheaders:
+                self.headers = []
+            self.inheaders = True
+            self.headers.append(buf)
+            self.pending.append(buf)
+            return
+        self.inheaders = False
+        if not buf.has_flags(Gst.BufferFlags.DELTA_UNIT):
+            self.gops.append(_gop())
+        elif not self.gops:
+            # the tail of a GOP that has been dropped (or that started
+            # before us) can't be decoded: wait for the next keyframe
+            self.dropped += buf.get_size()
+            return
+        gop = self.gops[-1]
+        gop.buffers.append(buf)
+        gop.bytes += buf.get_size()
+        self.bytes += buf.get_size()
+        # drop the oldest unsent GOP (keeping the one that is being sent,
+        # and the one that is being received)
+        while self.bytes > self.maxbytes and len(self.gops) > 1:
+            idx = 0
+            if self.gops[0].sent:
+                if len(self.gops) < 3:
+                    break
+                idx = 1
+            self._drop(idx)
+
+    def _drop(self, idx):
+        gop = self.gops[idx]
+        del self.gops[idx]
+        self.bytes -= gop.bytes
+        self.dropped += gop.bytes
+
+    def restart(self):
+        """
+        a new connection has to start with the headers, and at a keyframe
+        (the rest of a partially sent GOP is dropped, see add())
+        """
+        self.pending = collections.deque(self.headers)
+        while self.gops and self.gops[0].sent:
+            self._drop(0)
+
+    def pop(self):
+        """returns the next buffer to send (or None)"""
+        if self.pending:
+            return self.pending.popleft()
+        while self.gops:
+            gop = self.gops[0]
+            if gop.buffers:
+                buf = gop.buffers.popleft()
+                gop.sent += 1
+                gop.bytes -= buf.get_size()
+                self.bytes -= buf.get_size()
+                return buf
+            if gop is self.gops[-1]:
+                # still being received
+                return None
+            self.gops.popleft()
+        return None
+
+
+class netsink:
+    def __init__(self, appsink, url, name=None, maxbytes=_defaultbacklog):
+        self.appsink = appsink
+        self.url = url
+        self.name = name or appsink.get_name()
+        self.backlog = backlog(maxbytes)
+        self.lock = threading.Lock()
+        self.sender = None
+        self.appsrc = None
+        self.caps = None
+        self.connected = False
+        self.reconnects = 0
+        self.retry = _minretry
+        self.timer = None
+        self.statustimer = None
+        self.disconnected = 0.
+        # not connected before the first buffer has been sent
+        self.lost = time.time()
+        appsink.set_property('emit-signals', True)
+        appsink.connect('new-sample', self._newSample)
+        self._connect()
+
+    def _connect(self):
+        self.timer = None
+        self._stopSender()
+        log.info("%s: connecting to %s" % (self.name, self.url))
+        try:
+            sender = Gst.parse_launch(_sender(self.url))
+        except GLib.Error as e:
+            log.error("%s: %s" % (self.name, e))
+            self._disconnect(str(e))
+            return False
+        appsrc = sender.get_by_name("src")
+        appsrc.set_property('max-bytes', _senderbytes)
+        appsrc.connect('need-data', self._needData)
+        sinkpad = sender.get_by_name("sink").get_static_pad("sink")
+        sinkpad.add_probe(Gst.PadProbeType.BUFFER, self._renderProbe,
+                          sender, [0])
+        bus = sender.get_bus()
+        bus.add_watch(GLib.PRIORITY_DEFAULT, self._busHandler, None)
+        with self.lock:
+            if self.caps:
+                appsrc.set_property('caps', self.caps)
+            self.appsrc = appsrc
+            self.sender = sender
+            self.backlog.restart()
+            self.connected = True
+        sender.set_state(Gst.State.PLAYING)
+        self._flush()
+        return False
+
+    def _stopSender(self):
+        with self.lock:
+            sender = self.sender
+            self.sender = None
+            self.appsrc = None
+            self.connected = False
+        if sender:
+            sender.get_bus().remove_watch()
+            sender.set_state(Gst.State.NULL)
+
+    def _disconnect(self, reason):
+        if self.timer:
+            return
+        log.warn("%s: disconnected (%s), retrying in %ss"
+                 % (self.name, reason, self.retry))
+        self._stopSender()
+        if self.lost is None:
+            self.lost = time.time()
+        self.reconnects += 1
+        self.timer = GLib.timeout_add(int(self.retry * 1000), self._connect)
+        self.retry = min(self.retry * 2, _maxretry)
+        if not self.statustimer:
+            self.statustimer = GLib.timeout_add(
+                int(_statusinterval * 1000), self._status)
+        self._post()
+
+    def _busHandler(self, bus, message, data):
+        if message.type == Gst.MessageType.ERROR:
+            (err, debug) = message.parse_error()
+            self._disconnect(err.message)
+        elif message.type == Gst.MessageType.EOS:
+            self._disconnect("EOS")
+        return True
+
+    def _renderProbe(self, pad, info, sender, count):
+        # (streaming thread) a buffer only arrives at the sink once the
+        # previous one has been rendered
+        count[0] += 1
+        if count[0] < 2:
+            return Gst.PadProbeReturn.OK
+        GLib.idle_add(self._established, sender)
+        return Gst.PadProbeReturn.REMOVE
+
+    def _established(self, sender):
+        if sender is not self.sender:
+            # a stale sender
+            return False
+        self.retry = _minretry
+        if self.lost is not None:
+            log.info("%s: connected to %s" % (self.name, self.url))
+            self.disconnected += time.time() - self.lost
+            self.lost = None
+            self._post()
+        return False
+
+    def _status(self):
+        if self.lost is None:
+            self.statustimer = None
+            return False
+        self._post()
+        return True
+
+    def _newSample(self, appsink):
+        sample = appsink.emit('pull-sample')
+        if not sample:
+            return Gst.FlowReturn.OK
+        with self.lock:
+            caps = sample.get_caps()
+            if caps and self.appsrc and \
+                    not (self.caps and caps.is_equal(self.caps)):
+                self.appsrc.set_property('caps', caps)
+            self.caps = caps
+            self.backlog.add(sample.get_buffer())
+        self._flush()
+        return Gst.FlowReturn.OK
+
+    def _needData(self, appsrc, length):
+        self._flush()
+
+    def _flush(self):
+        # push from the backlog as long as the sender keeps up
+        with self.lock:
+            appsrc = self.appsrc
+            if not self.connected or not appsrc:
+                return
+            maxbytes = appsrc.get_property('max-bytes')
+            while appsrc.get_property('current-level-bytes') < maxbytes:
+                buf = self.backlog.pop()
+                if buf is None:
+                    break
+                if appsrc.emit('push-buffer', buf) != Gst.FlowReturn.OK:
+                    break
+
+    def stats(self):
+        disconnected = self.disconnected
+        if self.lost is not None:
+            disconnected += time.time() - self.lost
+        return {
+            'name': self.name,
+            'connected': self.lost is None,
+            'reconnects': self.reconnects,
+            'disconnected': disconnected,
+            'dropped-bytes': self.backlog.dropped,
+            'backlog-bytes': self.backlog.bytes,
+        }
+
+    def _post(self):
+        stats = self.stats()
+        s = Gst.Structure.new_empty("netsink")
+        s.set_value('name', stats['name'])
+        s.set_value('connected', stats['connected'])
+        s.set_value('reconnects', stats['reconnects'])
+        s.set_value('disconnected', float(stats['disconnected']))
+        s.set_value('dropped-bytes', int(stats['dropped-bytes']))
+        s.set_value('backlog-bytes', int(stats['backlog-bytes']))
+        msg = Gst.Structure.new_empty("netsink")
+        msg.set_value('netsink', s)
+        self.appsink.post_message(
+            Gst.Message.new_element(self.appsink, msg))
+
+    def stop(self):
+        for t in [self.timer, self.statustimer]:
+            if t:
+                GLib.source_remove(t)
+        self.timer = None
+        self.statustimer = None
+        self._stopSender()
+
+
+# ####################################################################
+if __name__ == '__main__':
+    # try with a local stand-in, e.g. 'nc -lk 5000 > /dev/null'
+    # (kill and restart it to see the reconnection)
+    import sys
+    Gst.init(None)
+    logging.basicConfig(level=logging.INFO)
+    url = "tcp://localhost:5000"
+    if len(sys.argv) > 1:
+        url = sys.argv[1]
+    pipeline = Gst.parse_launch(
+        'videotestsrc is-live=true ! x264enc tune=zerolatency key-int-max=30'
+        ' ! h264parse ! flvmux streamable=true'
+        ' ! appsink name=out sync=false async=false')
+    out = netsink(pipeline.get_by_name('out'), url)
+
+    def status(bus, message):
+        s = message.get_structure()
+        if s and s.has_field('netsink'):
+            print(s.get_value('netsink').to_string())
+    bus = pipeline.get_bus()
+    bus.add_signal_watch()
+    bus.connect('message::element', status)
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        GLib.MainLoop().run()
+    except KeyboardInterrupt:
+        pass
+    out.stop()
+    pipeline.set_state(Gst.State.NULL)
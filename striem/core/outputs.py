@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# outputs: publish the muxed stream to several destinations
+#
+# each [output.NAME] section of the configuration adds a branch to the
+# pipeline (replacing the @OUTPUTS@ macro), that takes the muxed stream
+# from the 'mout' tee (no re-encoding):
+#
+# [output.youtube]
+# url = rtmp://a.rtmp.youtube.com/live2/KEY
+#
+# [output.archive]
+# url = /var/lib/striem/archive.flv
+# enabled = 0
+#
+# - 'url' is either an RTMP-URL or a filename (or empty for a fakesink)
+# - 'enabled' is the initial state (see streamer.streamPause())
+# - 'buffer' is the time (in seconds) an output may lag behind, before
+#   it starts losing data (rather than holding back the other outputs)
+# - 'reconnect' (default: on for network urls) hands the data over to an
+#   auto-reconnecting sender (see netsink.py), rather than failing the
+#   pipeline if the connection drops; 'backlog' is the amount of data
+#   (in MB) kept while disconnected
+#
+# each branch has a leaky queue (so a slow destination never blocks the
+# tee, and thus neither the encoders nor the other outputs), and a valve
+# named like the output (to start/stop it without any state change; it is
+# reopened at a keyframe, after the stream headers, see valve.py).
+# without [output.NAME] sections, there's a single output "stream",
+# publishing to the [stream] url.
+
+import logging
+log = logging.getLogger(__name__)
+
+_branch = """
+%(source)s.
+! queue name=queue_%(name)s leaky=downstream max-size-time=%(buffer)d \
+max-size-bytes=0 max-size-buffers=0
+! valve name=%(name)s drop=%(drop)s
+! %(sink)s
+"""
+
+_defaultbuffer = 2.
+
+
+def _isnetwork(url):
+    for proto in ["rtmp://", "rtmps://", "tcp://"]:
+        if url and url.startswith(proto):
+            return True
+    return False
+
+
+def sink(name, url, reconnect=False):
+    """returns the pipeline description of a sink publishing to 'url'"""
+    if not url:
+        return "fakesink name=sink_%s async=false" % (name,)
+    if reconnect and _isnetwork(url):
+        # the actual sender is attached by the pipeline (see netsink.py)
+        return "appsink name=sink_%s sync=false async=false" % (name,)
+    if url.startswith("tcp://"):
+        (host, _, port) = url[len("tcp://"):].partition(':')
+        return "tcpclientsink name=sink_%s host=%s port=%s async=false" % (
+            name, host, port or 1935)
+    if url.startswith("rtmp://") or url.startswith("rtmps://"):
+        return "rtmpsink name=sink_%s location=%s async=false" % (name, url)
+    if url.startswith("file://"):
+        url = url[len("file://"):]
+    return "filesink name=sink_%s location=%s async=false" % (name, url)
+
+
+def _bool(value, default=True):
+    if value is None or value == "":
+        return default
+    try:
+        return bool(int(float(value)))
+    except ValueError:
+        return str(value).lower() in ['true', 'yes', 'on']
+
+
+def branch(name, url=None, enabled=None, buffertime=None, reconnect=None,
+           source="mout"):
+    """
+    returns the pipeline description for a single output
+    (of the muxed stream from the element 'source')
+    """
+    drop = not _bool(enabled)
+    reconnect = _bool(reconnect)
+    return _branch % {
+        'name': name,
+        'source': source,
+        'buffer': int(float(buffertime or _defaultbuffer) * 1000000000),
+        'drop': str(drop).lower(),
+        'sink': sink(name, url, reconnect),
+    }
+
+
+def outputs(outs, source="mout"):
+    """
+    'outs' is a list of (NAME, {option: value}) tuples
+    (e.g. from the [output.NAME] sections of the configuration)
+    publishing the muxed stream from the element 'source';
+    returns a tuple of
+    - the pipeline description for all outputs (for @OUTPUTS@)
+    - the names of the outputs
+    - the reconnecting outputs {sinkname: (url, backlog)}
+      (see pipeline.addNetsink())
+    """
+    pipestring = ""
+    names = []
+    netsinks = dict()
+    for (name, options) in outs:
+        log.info("output '%s': %s" % (name, options))
+        url = options.get('url')
+        reconnect = _bool(options.get('reconnect'))
+        pipestring += branch(name,
+                             url=url,
+                             enabled=options.get('enabled'),
+                             buffertime=options.get('buffer'),
+                             reconnect=reconnect,
+                             source=source)
+        names += [name]
+        if reconnect and _isnetwork(url):
+            backlog = options.get('backlog')
+            if backlog:
+                backlog = int(float(backlog) * 1024 * 1024)
+            netsinks["sink_%s" % (name,)] = (url, backlog)
+    return (pipestring, names, netsinks)
+
+
+def fromConfig(cfg):
+    """returns the outputs for all [output.NAME] sections in 'cfg'"""
+    prefix = "output."
+    outs = [(s[len(prefix):], cfg.getSectionDict(s))
+            for s in cfg.sections(prefix)]
+    if not outs:
+        outs = [("stream", {'url': cfg.get("stream", "url")})]
+    return outputs(outs)
+
+
+# ####################################################################
+if __name__ == '__main__':
+    (pipestring, names, netsinks) = outputs([
+        ('youtube', {'url': 'rtmp://localhost/live/test'}),
+        ('archive', {'url': '/tmp/archive.flv', 'enabled': 0}),
+    ])
+    print(pipestring)
+    print(names)
+    print(netsinks)
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# pre-rendered text overlays
+#
+# each text layer is rendered (with Pango/cairo) into an ARGB image
+# whenever one of its properties changes.
+# the 'overlaycomposition' element then only blends the covered rectangles
+# into each frame (or attaches them as meta, if downstream can do the
+# blending itself); nothing is laid out or rendered per frame.
+#
+# the layers mimic the properties of 'textoverlay' (with its default
+# alignment: centered horizontally, baseline at the bottom):
+# - text (pango markup), font-desc, deltax, deltay, silent,
+#   shaded-background
+# (with the defaults of the former textoverlays: "Sans 72", shaded).
+# 'overlaycomposition' (and its 'caps-changed'/'draw' signals) requires
+# GStreamer >= 1.20.
+
+import sys
+import threading
+import logging
+
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+gi.require_version('Pango', '1.0')
+gi.require_version('PangoCairo', '1.0')
+
+from gi.repository import GLib, GObject
+from gi.repository import Gst, GstVideo
+from gi.repository import Pango, PangoCairo
+import cairo
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = dict
+
+log = logging.getLogger(__name__)
+
+# padding (in pixels), as used by 'textoverlay'
+_xpad = 25
+_ypad = 25
+_boxpad = 6
+# opacity of the shaded background
+_shading = 80 / 255.
+_defaultfont = "Sans 72"
+
+# cairo's ARGB32 is native endian
+if 'little' == sys.byteorder:
+    _format = GstVideo.VideoFormat.BGRA
+else:
+    _format = GstVideo.VideoFormat.ARGB
+
+_fontdescs = dict()
+_context = None
+
+
+def fontdescription(desc):
+    """returns a (cached) Pango.FontDescription for the string 'desc'"""
+    try:
+        return _fontdescs[desc]
+    except KeyError:
+        pass
+    fd = Pango.FontDescription.from_string(desc or "")
+    _fontdescs[desc] = fd
+    return fd
+
+
+def _layout():
+    global _context
+    if _context is None:
+        _context = PangoCairo.FontMap.get_default().create_context()
+    return Pango.Layout.new(_context)
+
+
+class layer(GObject.Object):
+    """a single line of text (with the properties of 'textoverlay')"""
+    text = GObject.Property(type=str, default="")
+    font_desc = GObject.Property(type=str, default=_defaultfont)
+    deltax = GObject.Property(type=int, default=0,
+                              minimum=-(1 << 30), maximum=(1 << 30))
+    deltay = GObject.Property(type=int, default=0,
+                              minimum=-(1 << 30), maximum=(1 << 30))
+    silent = GObject.Property(type=bool, default=False)
+    shaded_background = GObject.Property(type=bool, default=True)
+
+    def __init__(self, name):
+        GObject.Object.__init__(self)
+        self.name = name
+        self.rectangle = None
+
+    def __repr__(self):
+        return "layer(%s)" % (self.name,)
+
+    def render(self, width, height):
+        """
+        renders the text for a frame of 'width'x'height' pixels
+        into self.rectangle (a GstVideo.VideoOverlayRectangle or None)
+        """
+        self.rectangle = None
+        if self.silent or not self.text or width <= 0 or height <= 0:
+            return None
+        layout = _layout()
+        fd = fontdescription(self.font_desc)
+        layout.set_font_description(fd)
+        layout.set_width((width - 2 * _xpad) * Pango.SCALE)
+        layout.set_wrap(Pango.WrapMode.WORD_CHAR)
+        layout.set_alignment(Pango.Alignment.CENTER)
+        try:
+            (_, attrs, text, _) = Pango.parse_markup(self.text, -1, u'\0')
+            layout.set_attributes(attrs)
+            layout.set_text(text, -1)
+        except GLib.Error:
+            layout.set_text(self.text, -1)
+
+        (_, logical) = layout.get_pixel_extents()
+        outline = max(1, int(fd.get_size() / Pango.SCALE / 15))
+        pad = outline
+        if self.shaded_background:
+            pad = max(pad, _boxpad)
+        w = logical.width + 2 * pad
+        h = logical.height + 2 * pad
+
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        cr = cairo.Context(surface)
+        if self.shaded_background:
+            cr.set_source_rgba(0, 0, 0, _shading)
+            cr.paint()
+        cr.translate(pad - logical.x, pad - logical.y)
+        PangoCairo.update_layout(cr, layout)
+        PangoCairo.layout_path(cr, layout)
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_line_width(2 * outline)
+        cr.stroke()
+        cr.set_source_rgb(1, 1, 1)
+        PangoCairo.show_layout(cr, layout)
+        surface.flush()
+
+        buf = Gst.Buffer.new_wrapped(bytes(surface.get_data()))
+        GstVideo.buffer_add_video_meta(buf, GstVideo.VideoFrameFlags.NONE,
+                                       _format, w, h)
+        baseline = layout.get_baseline() // Pango.SCALE
+        x = (width - w) // 2 + self.deltax
+        y = height - _ypad - (pad - logical.y + baseline) + self.deltay
+        self.rectangle = GstVideo.VideoOverlayRectangle.new_raw(
+            buf, x, y, w, h,
+            GstVideo.VideoOverlayFormatFlags.PREMULTIPLIED_ALPHA)
+        return self.rectangle
+
+
+class compositor:
+    """
+    draws text layers via an 'overlaycomposition' element.
+    layers are rendered when they change (in the thread changing them),
+    the streaming thread merely picks up the cached composition.
+    """
+    def __init__(self, lmn):
+        self.element = lmn
+        self.layers = OrderedDict()
+        self.width = 0
+        self.height = 0
+        self.composition = None
+        # 'lock' protects the composition (taken by the streaming thread),
+        # 'renderlock' serializes re-rendering
+        self.lock = threading.Lock()
+        self.renderlock = threading.Lock()
+        lmn.connect('caps-changed', self._capsChanged)
+        lmn.connect('draw', self._draw)
+
+    def layer(self, name):
+        """returns the layer 'name' (creating it if needed)"""
+        try:
+            return self.layers[name]
+        except KeyError:
+            pass
+        l = layer(name)
+        l.connect('notify', self._changed)
+        self.layers[name] = l
+        return l
+
+    def _changed(self, l, pspec):
+        with self.renderlock:
+            l.render(self.width, self.height)
+            self._compose()
+
+    def _compose(self):
+        composition = None
+        for l in self.layers.values():
+            if not l.rectangle:
+                continue
+            if composition is None:
+                composition = GstVideo.VideoOverlayComposition.new(
+                    l.rectangle)
+            else:
+                composition.add_rectangle(l.rectangle)
+        with self.lock:
+            self.composition = composition
+
+    def _capsChanged(self, lmn, caps, window_width, window_height):
+        s = caps.get_structure(0)
+        (_, width) = s.get_int('width')
+        (_, height) = s.get_int('height')
+        with self.renderlock:
+            if (width, height) == (self.width, self.height):
+                return
+            self.width = width
+            self.height = height
+            for l in self.layers.values():
+                l.render(width, height)
+            self._compose()
+
+    def _draw(self, lmn, sample):
+        with self.lock:
+            return self.composition
+
+
+# ####################################################################
+if __name__ == '__main__':
+    Gst.init(None)
+    pipeline = Gst.parse_launch(
+        'videotestsrc ! video/x-raw,width=1280,height=720'
+        ' ! overlaycomposition name=txt ! videoconvert ! autovideosink')
+    comp = compositor(pipeline.get_by_name('txt'))
+    piece = comp.layer('piece')
+    piece.set_property('font-desc', 'Sans 30')
+    piece.set_property('deltay', -300)
+    piece.set_property('text', 'Goldberg Variation #5')
+    composer = comp.layer('composer')
+    composer.set_property('font-desc', 'Sans 20')
+    composer.set_property('deltay', -200)
+    composer.set_property('text', 'J.S.Bach')
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        GLib.MainLoop().run()
+    except KeyboardInterrupt:
+        pass
+    pipeline.set_state(Gst.State.NULL)
@@ -19,10 +19,17 @@
 # along with striem.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import fnmatch
 import logging
+import threading
 import os.path
 import gi
 
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = dict
+
 log = logging.getLogger(__name__)
 
 
@@ -38,12 +45,70 @@ from gi.repository import GLib, GObject
 from gi.repository import Gst
 from gi.repository import GstVideo, GstController
 
-GObject.threads_init()
-Gst.init(None)
+from . import instrument as _instrument
+from . import netsink as _netsink
+from . import bitrate as _bitrate
+from . import replay as _replay
+from . import recorder as _recorder
+from . import meter as _meter
+from . import dispatcher as _dispatcher
+from . import valve as _valve
+from . import startup
+from .configuration import _tobool
+try:
+    from . import overlay as _overlay
+except (ImportError, ValueError):
+    _overlay = None
+
+_initialized = False
+_pluginextensions = ('.so', '.dll', '.dylib')
+# time (in seconds) teardown() waits for the EOS to reach the bus
+_eostimeout = 2.
+
+
+def _registered(registry, path):
+    """whether all plugins in 'path' are already known to the registry"""
+    try:
+        files = [f for f in os.listdir(path)
+                 if f.endswith(_pluginextensions)]
+    except OSError:
+        return True
+    for f in files:
+        if not registry.lookup(os.path.join(path, f)):
+            return False
+    return True
 
-# add path to our own gst-1.0 plugins
-reg = Gst.Registry().get()
-res = reg.scan_path(gst_extra_path)
+
+def init():
+    """
+    initializes GStreamer (only once), including our own gst-1.0 plugins.
+    this is done lazily (when the first pipeline is created), so importing
+    the module is cheap.
+    our plugin path is added to GST_PLUGIN_PATH, so the plugins end up in
+    GStreamer's registry cache (and are only re-scanned if they changed);
+    they are only scanned explicitly if they are missing from the registry.
+    """
+    global _initialized
+    if _initialized:
+        return
+    _initialized = True
+    if os.path.isdir(gst_extra_path):
+        paths = [p for p in
+                 os.environ.get('GST_PLUGIN_PATH', '').split(os.pathsep)
+                 if p]
+        if gst_extra_path not in paths:
+            os.environ['GST_PLUGIN_PATH'] = os.pathsep.join(
+                paths + [gst_extra_path])
+    GObject.threads_init()
+    Gst.init(None)
+    startup.mark("GStreamer initialized")
+
+    # add path to our own gst-1.0 plugins
+    reg = Gst.Registry.get()
+    if not _registered(reg, gst_extra_path):
+        log.info("scanning %s" % (gst_extra_path,))
+        reg.scan_path(gst_extra_path)
+        startup.mark("plugins scanned")
 
 # build a GStreamer pipeline,
 #  basic configuration: URL, sources, ...
@@ -51,9 +116,6 @@ res = reg.scan_path(gst_extra_path)
 #    - gain, delay, positions
 #  -
 
-# TODO: controllers for gst-1.0
-#         -> http://tangopardo.com.ar/2cf7/2013/07/30/
-
 
 class _dict_with_default(object):
     def __init__(self, data, default=None):
@@ -66,14 +128,20 @@ class _dict_with_default(object):
         except KeyError:
             return self.default
 
-patternmacro = re.compile('@([\w]*)@')
+patternmacro = re.compile('@([\w]*)(?::([^@\s]*))?@')
 
 def _replace_pipeline_macros(pipestring, data={}):
-    # replace all @XXX@ with %(XXX)s and then
-    # do a dictionary replacement (with unknown keys defaulting to '')
+    # replace all @XXX@ with the value of 'XXX' in data
+    # (unknown keys default to '', or to 'default' for @XXX:default@)
     if pipestring:
         mydata = _dict_with_default(data, default='')
-        return patternmacro.sub(r'%(\1)s', pipestring) % mydata
+
+        def replace(match):
+            value = mydata[match.group(1)]
+            if value is None or '' == value:
+                return match.group(2) or ''
+            return str(value)
+        return patternmacro.sub(replace, pipestring)
     return pipestring
 
 # pipeline descriptions:
@@ -185,13 +253,239 @@ def _ctrlRead(conffile=None):
     return ret
 
 
+def _toint(value):
+    return int(float(value))
+
+
+def _tostring(value):
+    if isinstance(value, (str, type(u''))):
+        return value
+    return str(value)
+
+
+def _toenum(value):
+    # enums are set by their numeric value (nicks are passed through)
+    try:
+        return int(float(value))
+    except ValueError:
+        return value
+
+
+_converters = [
+    (GObject.TYPE_BOOLEAN, _tobool),
+    (GObject.TYPE_INT, _toint),
+    (GObject.TYPE_UINT, _toint),
+    (GObject.TYPE_LONG, _toint),
+    (GObject.TYPE_ULONG, _toint),
+    (GObject.TYPE_INT64, _toint),
+    (GObject.TYPE_UINT64, _toint),
+    (GObject.TYPE_FLOAT, float),
+    (GObject.TYPE_DOUBLE, float),
+    (GObject.TYPE_STRING, _tostring),
+    (GObject.TYPE_ENUM, _toenum),
+    (GObject.TYPE_FLAGS, _toint),
+]
+
+
+def _converter(pspec):
+    """returns a function to convert values to the type of 'pspec'"""
+    for (gtype, fun) in _converters:
+        if GObject.type_is_a(pspec.value_type, gtype):
+            return fun
+    return lambda value: value
+
+
+class _target:
+    """
+    a resolved property (of an element or pad) a control is bound to.
+    the value is converted to the property's type,
+    and only set if it differs from the current value
+    (which is re-read, as others may change the property as well,
+    e.g. the bitrate controller).
+    """
+    def __init__(self, obj, pspec, name=None):
+        self.obj = obj
+        self.prop = pspec.name
+        self.name = name or pspec.name
+        self.convert = _converter(pspec)
+        self.readable = bool(pspec.flags & GObject.ParamFlags.READABLE)
+        self.value = None
+        if self.readable:
+            self.value = obj.get_property(self.prop)
+
+    def __repr__(self):
+        return self.name
+
+    def set(self, value):
+        try:
+            value = self.convert(value)
+        except (TypeError, ValueError):
+            log.warn("cannot set %s to '%s'" % (self.name, value))
+            return False
+        if self.readable:
+            self.value = self.obj.get_property(self.prop)
+        if value == self.value:
+            return False
+        log.debug("%s = %s", self.name, value)
+        try:
+            self.obj.set_property(self.prop, value)
+        except TypeError:
+            log.warn("cannot set %s to '%s'" % (self.name, value))
+            return False
+        self.value = value
+        return True
+
+
+_numeric = [
+    GObject.TYPE_INT, GObject.TYPE_UINT,
+    GObject.TYPE_LONG, GObject.TYPE_ULONG,
+    GObject.TYPE_INT64, GObject.TYPE_UINT64,
+    GObject.TYPE_FLOAT, GObject.TYPE_DOUBLE,
+]
+
+
+def _controllable(pspec):
+    """whether the property can be driven by an interpolation control-source"""
+    if not pspec.flags & Gst.PARAM_CONTROLLABLE:
+        return False
+    return pspec.value_type in _numeric
+
+
+class _ramp(_target):
+    """
+    a controllable property, driven by an InterpolationControlSource.
+    new values are scheduled on the pipeline clock, so the elements
+    interpolate them (sample accurately) within their streaming threads.
+    """
+    def __init__(self, obj, pspec, name, pipeline):
+        _target.__init__(self, obj, pspec, name)
+        self.pipeline = pipeline
+        self.source = GstController.InterpolationControlSource()
+        self.source.set_property(
+            'mode', GstController.InterpolationMode.LINEAR)
+        binding = GstController.DirectControlBinding.new_absolute(
+            obj, self.prop, self.source)
+        obj.add_control_binding(binding)
+        if self.value is not None:
+            self.source.set(0, float(self.value))
+
+    def _now(self):
+        # the current running-time of the pipeline (or None if not running)
+        clock = self.pipeline.get_clock()
+        if not clock:
+            return None
+        return max(clock.get_time() - self.pipeline.get_base_time(), 0)
+
+    def set(self, value, time=0):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            log.warn("cannot set %s to '%s'" % (self.name, value))
+            return False
+        now = self._now()
+        if now is None:
+            # not running: the value applies from the start
+            self.source.unset_all()
+            self.source.set(0, value)
+            self.obj.set_property(self.prop, self.convert(value))
+            self.value = value
+            return True
+        # start the ramp from the current (possibly interpolated) value
+        (ok, current) = self.source.get_value(now)
+        if not ok:
+            current = self.value
+        self.source.unset_all()
+        duration = int(time * Gst.SECOND)
+        if duration > 0 and current is not None:
+            self.source.set(now, float(current))
+            self.source.set(now + duration, value)
+        else:
+            self.source.set(now, value)
+        log.debug("%s -> %s in %ss", self.name, value, time)
+        self.value = value
+        return True
+
+
+class _padoffset(_target):
+    """
+    the 'offset' of a src-pad (shifting the running-time of a branch).
+    a new offset is applied when the next keyframe enters the element,
+    so a delay change of an encoded stream never splits a GOP.
+    if the offset decreases, buffers are dropped (up to the next keyframe
+    that fits), so the timestamps keep increasing.
+    """
+    def __init__(self, obj, pspec, name=None):
+        _target.__init__(self, obj, pspec, name)
+        self.pending = None
+        self.last = None
+        self.skipping = False
+        self.probe = None
+        lmn = obj.get_parent_element()
+        self.sinkpad = None
+        if lmn and lmn.sinkpads:
+            self.sinkpad = lmn.sinkpads[0]
+
+    def _time(self, buf):
+        if buf.dts != Gst.CLOCK_TIME_NONE:
+            return buf.dts
+        if buf.pts != Gst.CLOCK_TIME_NONE:
+            return buf.pts
+        return None
+
+    def _probe(self, pad, info):
+        buf = info.get_buffer()
+        t = self._time(buf)
+        if t is None:
+            return Gst.PadProbeReturn.OK
+        pending = self.pending
+        if pending is not None and \
+                not buf.has_flags(Gst.BufferFlags.DELTA_UNIT):
+            if self.last is None or t + pending > self.last:
+                self.obj.set_offset(pending)
+                self.pending = None
+                self.skipping = False
+                log.debug("%s = %s @ %s", self.name, pending, t)
+            else:
+                # this GOP would go back in time
+                self.skipping = True
+                return Gst.PadProbeReturn.DROP
+        elif self.skipping:
+            return Gst.PadProbeReturn.DROP
+        self.last = t + self.obj.get_offset()
+        return Gst.PadProbeReturn.OK
+
+    def set(self, value):
+        try:
+            value = self.convert(value)
+        except (TypeError, ValueError):
+            log.warn("cannot set %s to '%s'" % (self.name, value))
+            return False
+        if value == self.value:
+            return False
+        self.value = value
+        if not self.sinkpad:
+            self.obj.set_offset(value)
+            return True
+        self.pending = value
+        if not self.probe:
+            self.probe = self.sinkpad.add_probe(Gst.PadProbeType.BUFFER,
+                                                self._probe)
+        return True
+
+
 class pipeline:
-    def __init__(self, filename="default.gst", config=dict()):
+    def __init__(self, filename="default.gst", config=dict(), pipestring=None,
+                 instrument=False, controls=None):
         self.eventhandlers = dict()
         self.eventkeys = dict()
         self.restart = False
         self.controller = dict()
         self.setter = dict()
+        self.targets = dict()
+        self.pendingControls = OrderedDict()
+        self.controlTimer = None
+        # apply control updates at most once per video frame (in msec)
+        self.controlInterval = None
         self.pipestring = ""
 
         self.pipeline = None
@@ -199,8 +493,20 @@ class pipeline:
         self.previewOut = None
         self.liveOut = None
         self.recorder = None
+        self.recorders = []
+        self.dispatcher = None
+        self.eos = threading.Event()
+        self.tracer = None
+        self.overlays = dict()
+        self.netsinks = dict()
+        self.valves = dict()
+        self.meters = dict()
+        self.replay = None
+        self.bitrate = None
+        self.queuereporter = None
 
         self.config = config
+        init()
 
         conffile = None
         log.info("pipefile: %s" % (filename))
@@ -211,44 +517,53 @@ class pipeline:
 
         # (self.pipestring, ctrls) =
         #     _pipeParseCtrl(_pipeRead(filename, config))
-        self.pipestring = _pipeRead(filename, config)
+        # an explicit 'pipestring' replaces the content of 'filename'
+        # (the controls are still read from the accompanying .ctl-file,
+        #  'controls' are added to them)
+        if pipestring is None:
+            pipestring = _pipeRead(filename, config)
+        self.pipestring = pipestring
         ctrls = _ctrlRead(conffile)
+        # additional controls (e.g. for generated branches)
+        for ctl, elemprop in (controls or dict()).items():
+            if ctrls is None:
+                ctrls = dict()
+            if ctl not in ctrls:
+                ctrls[ctl] = dict()
+            for elem, props in elemprop.items():
+                ctrls[ctl][elem] = ctrls[ctl].get(elem, []) + props
 
         log.info("pipeline: %s" % (self.pipestring))
         log.info("ctrls: %s" % (ctrls))
 
-        self.setEventHandlers({Gst.MessageType.EOS: self._EOS})
+        self.pipeline = Gst.parse_launch(self.pipestring)
+        startup.mark("pipeline built")
+        self.bus = self.pipeline.get_bus()
+        # the bus is dispatched in a thread of its own (see dispatcher.py)
+        self.dispatcher = _dispatcher.dispatcher(self.bus, self._onEvent)
+        self.bus.set_sync_handler(self._sync_handler, None)
+
+        self.setEventHandlers(None)
         self.setEventHandlers(
             {Gst.MessageType.ELEMENT: self._handleElementEvent}
         )
+        self.setEventHandlers(
+            {Gst.MessageType.STATE_CHANGED: self._stateChanged}
+        )
+        self.setEventHandlers({Gst.MessageType.ERROR: self._error})
 
         self.setEventKeys(None)
-
-        self.pipeline = Gst.parse_launch(self.pipestring)
-        self.bus = self.pipeline.get_bus()
-        self.bus.add_watch(GLib.PRIORITY_DEFAULT, self._async_handler, None)
         # # enabling the following triggers an assertion (and exists)
         # Gst.Bus.add_signal_watch(self.bus)
 
         self.previewOut = self.pipeline.get_by_name("preview")
         self.liveOut = self.pipeline.get_by_name("preview")
-        self.recorder = self.pipeline.get_by_name("recorder")
+        self._setupOverlays()
 
         log.info("OUT: %s\t%s", self.previewOut, self.liveOut)
 
-        # get all controllables
-        control_dict = {}
-        try:
-            pipelements = iter(self.pipeline.iterate_elements())
-        except TypeError:
-            log.exception("'python3-gst-1.0' required?")
-            return
-        for lmn in pipelements:
-            for p in lmn.props:
-                if False and p.flags & Gst.PARAM_CONTROLLABLE:
-                    if lmn.props.name not in control_dict:
-                        control_dict[lmn.props.name] = []
-                    control_dict[lmn.props.name] += [p.name]
+        if instrument:
+            self.tracer = _instrument.tracer(self.pipeline)
 
         if ctrls:
             for ctl, elemprop in ctrls.items():
@@ -260,70 +575,261 @@ class pipeline:
                 for elem, props in elemprop.items():
                     # elem = 'textoverlay_3'
                     # prop = ['xpos']
-                    ctlprops = []
-                    setprops = []
+                    # resolved once, so setControl() is a direct dispatch
                     for p in props:
-                        if ((elem in control_dict and
-                             p in control_dict[elem])):
-                            ctlprops += [p]
-                        setprops += [p]
-                    lmn = self.pipeline.get_by_name(elem)
-                    log.debug("element '%s' %s" % (elem, lmn))
-                    # create a controller
-                    if ctlprops:
-                        log.info("ctlprops: %s@%s : %s" % (elem, ctlprops, ctl))
-                        # tmpctl = Gst.Controller(lmn, *ctlprops)
-                        for cp in ctlprops:
-                            v = lmn.get_property(cp)
-                            if not isinstance(v, float):
-                                continue
-                            tmpctl = GstController.InterpolationControlSource()
-                            tmpctl.set_property('mode', GstController.InterpolationMode.LINEAR)
-                            cb = GstController.DirectControlBinding.new(lmn, cp, tmpctl)
-                            lmn.add_control_binding(cb)
-
-                            log.debug("%s: %s" % (ctl, v))
-                            tmpctl.set(0, v)
-
+                        target = self._getTarget(elem, p)
+                        if not target:
+                            continue
+                        # controllable properties are driven by a
+                        # control-source (and can be ramped)
+                        if isinstance(target, _ramp):
                             if ctl not in self.controller:
                                 self.controller[ctl] = []
-                            self.controller[ctl] += [(tmpctl, ctlprops)]
-                    # create setters
-                    # (this is just a list so we remember)
-                    if setprops:
-                        if ctl not in self.setter:
-                            self.setter[ctl] = {}
-                        if lmn not in self.setter[ctl]:
-                            self.setter[ctl][lmn] = []
-                        self.setter[ctl][lmn] += setprops
+                            self.controller[ctl] += [target]
+                        else:
+                            if ctl not in self.setter:
+                                self.setter[ctl] = []
+                            self.setter[ctl] += [target]
 
         log.warn("controller: %s" % (self.controller,))
         log.warn("setter: %s" % (self.setter,))
 
+    def _setupOverlays(self):
+        # text layers are drawn by 'overlaycomposition' elements
+        for lmn in self.pipeline.iterate_recurse():
+            factory = lmn.get_factory()
+            if not factory or "overlaycomposition" != factory.get_name():
+                continue
+            if not _overlay:
+                log.error("cannot draw text on '%s' (missing Pango/cairo)"
+                          % (lmn.get_name(),))
+                continue
+            self.overlays[lmn.get_name()] = _overlay.compositor(lmn)
+
+    def addNetsink(self, elementname, url, backlog=None):
+        """
+        attach an auto-reconnecting sender for 'url' to the appsink
+        'elementname' (see netsink.py)
+        """
+        lmn = self.pipeline.get_by_name(elementname)
+        if not lmn:
+            log.warn("no such sink '%s'" % (elementname,))
+            return None
+        if backlog:
+            sink = _netsink.netsink(lmn, url, maxbytes=backlog)
+        else:
+            sink = _netsink.netsink(lmn, url)
+        self.netsinks[elementname] = sink
+        return sink
+
+    def addValve(self, elementname):
+        """
+        reopen the valve 'elementname' at a keyframe, preceded by the
+        stream headers (see valve.py)
+        """
+        lmn = self.pipeline.get_by_name(elementname)
+        if not lmn:
+            log.warn("no such valve '%s'" % (elementname,))
+            return None
+        v = _valve.valve(lmn)
+        self.valves[elementname] = v
+        return v
+
+    def addMeter(self, elementname, interval=None):
+        """
+        aggregate the messages of the 'level' element 'elementname'
+        (see meter.py); use meter.subscribe() to get the updates
+        """
+        lmn = self.pipeline.get_by_name(elementname)
+        if not lmn:
+            log.warn("no such element '%s'" % (elementname,))
+            return None
+        m = _meter.meter(lmn, interval)
+        self.meters[elementname] = m
+        return m
+
+    def addReplay(self, elementname, filename, maxbytes=None, length=None):
+        """
+        keep the last 'length' seconds of the data arriving at the appsink
+        'elementname' in the ring file 'filename' (see replay.py)
+        """
+        lmn = self.pipeline.get_by_name(elementname)
+        if not lmn:
+            log.warn("no such sink '%s'" % (elementname,))
+            return None
+        self.replay = _replay.replay(lmn, filename, maxbytes, length)
+        return self.replay
+
+    def saveReplay(self, seconds, filename):
+        """writes the last 'seconds' of the replay ring to 'filename'"""
+        if not self.replay:
+            log.warn("no replay")
+            return None
+        return self.replay.save(seconds, filename)
+
+    def setQueuePolicy(self, pattern, policy):
+        """
+        apply 'policy' (a {property: value} dictionary, e.g.
+        {'max-size-time': 2000000000, 'leaky': 'downstream'})
+        to all queues whose name matches 'pattern' (shell-style wildcards)
+        """
+        for lmn in self.pipeline.iterate_recurse():
+            factory = lmn.get_factory()
+            if not factory or "queue" != factory.get_name():
+                continue
+            name = lmn.get_name()
+            if not fnmatch.fnmatchcase(name, pattern):
+                continue
+            log.info("queue '%s': %s" % (name, policy))
+            for prop, value in policy.items():
+                self.setProperty(name, prop, value)
+
+    def reportQueues(self, interval=1.):
+        """
+        post the current and peak fill levels of all queues every
+        'interval' seconds (as 'queue-level' ELEMENT messages,
+        use setEventKeys({'queue-level': fun}) to receive them).
+        an 'interval' of 0 stops reporting.
+        """
+        if self.queuereporter:
+            self.queuereporter.stop()
+            self.queuereporter = None
+        if interval:
+            self.queuereporter = _instrument.queuereporter(self.pipeline,
+                                                           interval)
+
+    def addBitrateController(self, encoder, queues, minimum, maximum,
+                             **kwargs):
+        """
+        adapt the bitrate of the 'encoder' element (between 'minimum' and
+        'maximum' kbit/s) to the backlog of the output branches:
+        the fill levels of the 'queues' (element names) and of all netsinks.
+        additional arguments are passed to bitrate.controller()
+        """
+        lmn = self.pipeline.get_by_name(encoder)
+        if not lmn:
+            log.warn("no such encoder '%s'" % (encoder,))
+            return None
+        sources = []
+        for name in queues:
+            q = self.pipeline.get_by_name(name)
+            if q:
+                sources += [_bitrate.queuefill(q)]
+        for sink in self.netsinks.values():
+            sources += [_bitrate.backlogfill(sink)]
+        if self.bitrate:
+            self.bitrate.stop()
+        self.bitrate = _bitrate.controller(lmn, sources, minimum, maximum,
+                                           **kwargs)
+        return self.bitrate
+
+    def bitrateStats(self):
+        """
+        returns the current bitrate and the history of decisions of the
+        bitrate controller (or None)
+        """
+        if not self.bitrate:
+            return None
+        return self.bitrate.stats()
+
     def teardown(self):
+        if self.tracer:
+            self.tracer.stop()
+        if self.bitrate:
+            self.bitrate.stop()
+        if self.queuereporter:
+            self.queuereporter.stop()
+        for sink in self.netsinks.values():
+            sink.stop()
+        for m in self.meters.values():
+            m.stop()
+        if self.replay:
+            self.replay.stop()
         self.EOS()
+        if self.dispatcher:
+            # the EOS is handled by the dispatcher
+            self.eos.wait(_eostimeout)
+            self.pipeline.set_state(Gst.State.NULL)
+            self.dispatcher.stop()
 
-    def _async_handler(self, bus, message, data):
-        try:
-            ret = self.eventhandlers[message.type](bus, message)
-        except KeyError:
-            ret = self.onEvent(bus, message)
-        if ret is None:
-            return True
-        return bool(ret)
+    def stats(self, reset=False):
+        """
+        returns the statistics collected in instrumentation mode
+        (per element processing time, per queue fill level and
+        per branch latency; see instrument.tracer.stats())
+        or None if the pipeline is not instrumented.
+        if 'reset' is True, the statistics are cleared afterwards.
+        """
+        if not self.tracer:
+            return None
+        result = self.tracer.stats()
+        if reset:
+            self.tracer.reset()
+        return result
+
+    def _sync_handler(self, bus, message, data):
+        # called in the thread posting the message:
+        # high-rate messages are consumed right here
+        if message.type == Gst.MessageType.ELEMENT:
+            for m in self.meters.values():
+                if m.handleMessage(message):
+                    return Gst.BusSyncReply.DROP
+        return Gst.BusSyncReply.PASS
 
     def _EOS(self, bus, message):
         self.pipeline.set_state(Gst.State.NULL)
+        self.eos.set()
+
+    def _error(self, bus, message):
+        (err, debug) = message.parse_error()
+        log.error("%s: %s" % (message.src.get_name(), err.message))
+        log.debug("%s" % (debug,))
+
+    def _stateChanged(self, bus, message):
+        if message.src != self.pipeline:
+            return
+        (old, new, pending) = message.parse_state_changed()
+        if new == Gst.State.PLAYING:
+            startup.mark("pipeline PLAYING")
+
+    def _firstFrame(self, pad, info):
+        startup.mark("first encoded frame")
+        return Gst.PadProbeReturn.REMOVE
+
+    def _onEvent(self, bus, message):
+        return self.onEvent(bus, message)
 
     def onEvent(self, bus, message):
         """catch all events not handled by more specific handlers"""
         pass
 
     def _handleElementEvent(self, bus, message):
+        # the event-key handlers are GUI callbacks,
+        # so they are called in the GUI thread
         struct = message.get_structure()
-        for key, fun in self.eventkeys.items():
-            if struct and struct.has_field(key):
-                fun(struct.get_value(key), key)
+        if not struct:
+            return
+        for key, fun in list(self.eventkeys.items()):
+            if struct.has_field(key):
+                GLib.idle_add(self._callEventKey,
+                              fun, struct.get_value(key), key)
+
+    def _callEventKey(self, fun, value, key):
+        fun(value, key)
+        return False
+
+    def subscribe(self, fun, msgtype=None, source=None, name=None,
+                  gui=False):
+        """
+        calls fun(bus, message) for all messages of type 'msgtype',
+        posted by the element named 'source', with a structure named 'name'
+        (None matches anything); in the bus thread, or (if 'gui' is True)
+        in the GUI thread. see dispatcher.subscribe()
+        """
+        return self.dispatcher.subscribe(fun, msgtype, source, name, gui)
+
+    def unsubscribe(self, subscription):
+        self.dispatcher.unsubscribe(subscription)
 
     def setEventHandlers(self, handlers=dict()):
         """
@@ -333,13 +839,24 @@ class pipeline:
         handlers are added in cumulative way (calling this functions multiple
         times will add/update the event-handlers for the given msg-types)
         an None handler will reset the event-handlers to the default.
+        the handlers are called in the bus thread (see dispatcher.py).
         """
         if handlers is None:
-            self.eventhandlers = {Gst.MessageType.EOS: self._EOS}
-        else:
-            self.eventhandlers.update(handlers)
+            for sub in self.eventhandlers.values():
+                self.unsubscribe(sub)
+            self.eventhandlers = dict()
+            handlers = {Gst.MessageType.EOS: self._EOS}
+        for msgtype, fun in handlers.items():
+            sub = self.eventhandlers.pop(msgtype, None)
+            if sub:
+                self.unsubscribe(sub)
+            self.eventhandlers[msgtype] = self.subscribe(fun, msgtype)
 
     def setEventKeys(self, handlers=dict()):
+        """
+        calls fun(value, key) (in the GUI thread) for each ELEMENT message
+        with a field 'key', using a (key -> function) mapping
+        """
         if handlers is None:
             self.eventkeys = dict()
         else:
@@ -347,100 +864,145 @@ class pipeline:
 
     def EOS(self):
         log.info("EOS")
-        self.pipeline.send_event(gst.Event.new_eos())
+        self.pipeline.send_event(Gst.Event.new_eos())
 
     def run(self, state=True):
+        self.flushControls()
         if(state):
+            encoder = self.pipeline.get_by_name("venc")
+            if encoder and not startup.marked("first encoded frame"):
+                encoder.get_static_pad("src").add_probe(
+                    Gst.PadProbeType.BUFFER, self._firstFrame)
             self.pipeline.set_state(Gst.State.PLAYING)
         else:
             self.pipeline.set_state(Gst.State.READY)
 
-    def record(self, filename=None):
-        # controls the element named 'record'
-        #  if a filename is given, start recording to this name
-        #    recorder.set_state(gst.STATE_PLAYING)
-        #  if no filename is given, stop recording
-        #    recorder.send_event(gst.event_new_eos())
-        log.info("recording in %s: %s" % (self.recorder, filename))
-        if not self.recorder:
-            return False
-        # TODO: check current state of recorder
-        if filename:
-            self.recorder.set_state(Gst.State.PLAYING)
-        else:
-            self.recorder.send_event(Gst.Event.new_eos())
-            self.recorder.set_state(Gst.State.PAUSED)
+    def record(self, filename=None, segment=None, muxer=None):
+        """
+        starts recording (in segments of 'segment' seconds) to 'filename',
+        or stops the recording if no filename is given (see recorder.py).
+        the recording branch is attached/detached while the pipeline runs.
+        """
+        log.info("recording: %s" % (filename,))
+        if self.recorder:
+            self.recorder.stop()
+            self.recorder = None
+        if not filename:
+            return True
+        # forget about finished recordings
+        for rec in [r for r in self.recorders if r.finished]:
+            self.unsubscribe(rec.subscription)
+            self.recorders.remove(rec)
+        rec = _recorder.recorder(self.pipeline, filename, segment, muxer)
+        # the recorder tracks the segments via the messages of its sink
+        # (in the main loop, like its finalization timeout)
+        rec.subscription = self.subscribe(
+            lambda bus, message: rec.handleMessage(message),
+            Gst.MessageType.ELEMENT, rec.sink.get_name(), gui=True)
+        self.recorders += [rec]
+        self.recorder = rec
+        return True
 
     def _setControlTime(self, name, value, time):
-        if not isinstance(value, float):
-            return False
-        log.info("setControlTime(%s,%s,%s)" % (name, value, time))
-        success = False
-        if name in self.controller:
-            success = True
-            gsttime = time * Gst.SECOND
-            clock = self.pipeline.get_clock()
-            if clock:
-                gsttime += clock.get_time()
-            for (ctl, props) in self.controller[name]:
-                try:
-                    log.debug("%s.set(%s,%s)" % (ctl, gsttime, value))
-                    ctl.set(gsttime, value)
-                except TypeError:
-                    log.exception("timedcontroller failed")
-                    success = False
-        return success
+        log.debug("setControlTime(%s,%s,%s)", name, value, time)
+        for ramp in self.controller[name]:
+            ramp.set(value, time)
 
     def _setControl(self, name, value):
-        log.info("setControl(%s,%s)" % (name, value))
-        if name in self.setter:
-            for (lmn, props) in self.setter[name].items():
-                log.debug("lmn[%s] %s:%s" % (name, lmn, props))
-                if not lmn:
-                    continue
-                for p in props:
-                    (ppad, _, prop) = p.partition("::")
-                    if prop:
-                        havepads = [pad
-                                    for pad in lmn.pads
-                                    if pad.name == ppad]
-                        if havepads:
-                            lmn = havepads[0]
-                    else:
-                        prop = p
-                    log.debug("%s.set_property(%s,%s)" % (lmn, prop, value))
-                    lmn.set_property(prop, value)
+        log.debug("setControl(%s,%s)", name, value)
+        for target in self.setter.get(name, ()):
+            target.set(value)
 
     def setControl(self, name, value, time=0):
-        if self._setControlTime(name, value, time):
+        """
+        set all properties bound to 'name' to 'value'.
+        controllable properties are ramped to the new value within 'time'
+        seconds (in the streaming threads), all others are set (once per
+        video frame) from the main loop.
+        """
+        if name in self.controller:
+            self._setControlTime(name, value, time)
+        if name not in self.setter:
             return
-        self._setControl(name, value)
+        # coalesce the updates (per control name),
+        # they are applied from the main loop once per video frame
+        self.pendingControls[name] = value
+        if self.controlTimer is None:
+            interval = self.controlInterval or self._frameInterval()
+            self.controlTimer = GLib.timeout_add(
+                interval, self._flushControls)
+
+    def _flushControls(self):
+        self.controlTimer = None
+        pending = self.pendingControls
+        self.pendingControls = OrderedDict()
+        for name, value in pending.items():
+            self._setControl(name, value)
+        return False
 
-    def setProperty(self, element, prop, value):
-        lmn = self.pipeline.get_by_name(element)
-        if not lmn:
-            # continue
-            return
-        # try to guess the correct type for the given property
-        # we do that by iterating through a few known types, namely:
-        # - the original type (whatever that was)
-        # - str
-        # - float
-        # - int
-        # and stop after the first one that doesn't throw an error
-        for fun in [lambda arg:arg, str, float, lambda arg: int(float(arg))]:
-            try:
-                x = fun(value)
-                try:
-                    lmn.set_property(prop, x)
-                    # success, let's exit the type-guessing loop
-                    break
-                except TypeError:
-                    # this happens if set_property doesn't like the given type
+    def flushControls(self):
+        """apply all pending control updates immediately"""
+        if self.controlTimer is not None:
+            GLib.source_remove(self.controlTimer)
+        self._flushControls()
+
+    def _frameInterval(self):
+        # get the duration of a video frame (in msec) from the negotiated caps
+        # (falls back to 30fps until the pipeline has been negotiated)
+        for lmn in self.pipeline.iterate_recurse():
+            for pad in lmn.srcpads:
+                caps = pad.get_current_caps()
+                if not caps or caps.is_empty():
                     continue
-            except ValueError:
-                # this happens if the conversion to the target type fails
-                continue
+                struct = caps.get_structure(0)
+                if not struct.get_name().startswith("video/x-raw"):
+                    continue
+                (ok, num, denom) = struct.get_fraction("framerate")
+                if ok and num > 0:
+                    self.controlInterval = max(int(1000 * denom / num), 1)
+                    return self.controlInterval
+        return int(1000 / 30)
+
+    def _getTarget(self, element, prop):
+        # resolve (and remember) the object/property 'element.prop' refers to
+        # 'prop' can be 'PAD::PROPERTY' to address a property of a pad
+        key = (element, prop)
+        try:
+            return self.targets[key]
+        except KeyError:
+            pass
+        target = None
+        obj = self.pipeline.get_by_name(element)
+        (padname, _, padprop) = prop.partition("::")
+        if element in self.overlays:
+            # the text layers of an overlay are addressed as 'LAYER::PROP'
+            # ('PROP' addresses the layer named like the element)
+            if not padprop:
+                padname = element
+                padprop = prop
+            obj = self.overlays[element].layer(padname)
+            prop = padprop
+        elif obj and padprop:
+            obj = obj.get_static_pad(padname)
+            prop = padprop
+        if obj:
+            pspec = obj.find_property(prop)
+            if pspec and _controllable(pspec):
+                target = _ramp(obj, pspec, "%s.%s" % key, self.pipeline)
+            elif pspec and isinstance(obj, Gst.Pad) and "offset" == prop \
+                    and obj.get_direction() == Gst.PadDirection.SRC:
+                target = _padoffset(obj, pspec, "%s.%s" % key)
+            elif pspec:
+                target = _target(obj, pspec, "%s.%s" % key)
+        if not target:
+            log.warn("unable to resolve '%s.%s'" % key)
+        self.targets[key] = target
+        return target
+
+    def setProperty(self, element, prop, value):
+        target = self._getTarget(element, prop)
+        if target:
+            target.set(value)
 
     def setGui(self, gui):
         # http://stackoverflow.com/questions/1873113/
@@ -478,7 +1040,18 @@ class pipeline:
             self.pipeline.set_state(state)
             log.debug("pipeline :: %s" % (self.pipeline.get_state(0)))
             return _state
+        if elementname in self.valves:
+            self.valves[elementname].set(bool(_state))
+            log.debug("valve %s :: drop=%s" % (elementname, bool(_state)))
+            return _state
         lmn = self.pipeline.get_by_name(elementname)
+        factory = lmn and lmn.get_factory()
+        if factory and "valve" == factory.get_name():
+            # outputs are stopped by dropping their data
+            # (without changing any state)
+            lmn.set_property("drop", bool(_state))
+            log.debug("lmn = %s :: drop=%s" % (lmn, bool(_state)))
+            return _state
         if lmn:
             if _state:
                 lmn.set_state(Gst.State.PAUSED)
@@ -488,6 +1061,29 @@ class pipeline:
             return _state
         return False
 
+    def select(self, selectorname, elementname):
+        """
+        makes the input-selector 'selectorname' pass the branch that ends
+        in the element 'elementname' (from the next buffer on; without
+        any state change)
+        """
+        selector = self.pipeline.get_by_name(selectorname)
+        lmn = self.pipeline.get_by_name(elementname)
+        if not selector or not lmn:
+            log.warn("cannot select '%s' in '%s'" % (elementname,
+                                                     selectorname))
+            return False
+        pad = lmn.get_static_pad("src")
+        pad = pad and pad.get_peer()
+        if not pad or pad.get_parent_element() != selector:
+            log.warn("'%s' is not connected to '%s'" % (elementname,
+                                                        selectorname))
+            return False
+        if selector.get_property('active-pad') != pad:
+            log.info("%s: %s" % (selectorname, elementname))
+            selector.set_property('active-pad', pad)
+        return True
+
 
 # #####################################################################
 if __name__ == '__main__':
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# segmented recording
+#
+# a recording is a branch that is attached to the tees of the encoded
+# video ('vencout') and audio ('aout') while the pipeline is running,
+# and detached again when the recording stops (nothing is re-encoded).
+# the branch ends in a 'splitmuxsink', that writes a new file every
+# 'segment' seconds (starting at a keyframe), so a crash only loses the
+# last segment. the segments are finalized in the background.
+#
+# the branch is added and removed without any state change of the
+# pipeline (it handles its state changes itself), and has its own leaky
+# queues, so a slow disk never holds back the live stream.
+# recording starts with the next keyframe (rather than forcing one),
+# stopping sends EOS into the branch (only), and removes it once the last
+# segment has been finalized.
+#
+# [record]
+# segment = 60
+# muxer = mp4mux
+
+import os
+import logging
+
+from gi.repository import GLib
+from gi.repository import Gst
+
+log = logging.getLogger(__name__)
+
+_defaultsegment = 60.
+_defaultmuxer = "mp4mux"
+# data (in nsec) a branch may lag behind before it loses data
+_buffertime = 5 * Gst.SECOND
+# time (in msec) to wait for the last segment, before removing the branch
+_finalizetimeout = 10000
+
+
+def location(filename):
+    """
+    returns the location pattern for the segments of 'filename'
+    (e.g. 'rec.mp4' -> 'rec-%05d.mp4')
+    """
+    if '%' in filename:
+        return filename
+    (base, ext) = os.path.splitext(filename)
+    return "%s-%%05d%s" % (base, ext or ".mp4")
+
+
+class recorder:
+    def __init__(self, pipeline, filename, segment=None, muxer=None,
+                 video="vencout", audio="aout"):
+        """
+        starts recording the tees 'video' and 'audio' of 'pipeline'
+        into segments of 'segment' seconds (see location())
+        """
+        self.pipeline = pipeline
+        self.location = location(filename)
+        self.segment = float(segment or _defaultsegment)
+        self.muxer = muxer or _defaultmuxer
+        self.started = False
+        self.stopping = False
+        self.finished = False
+        self.opened = 0
+        self.closed = 0
+        self.timer = None
+        # (tee, teepad, ghostpad)
+        self.links = []
+        self.bin = None
+        self.sink = None
+        self._attach(video, audio)
+
+    def _attach(self, video, audio):
+        self.bin = Gst.Bin.new(None)
+        # don't let the preroll of the new sink pause the pipeline
+        self.bin.set_property('async-handling', True)
+        self.sink = Gst.ElementFactory.make("splitmuxsink", None)
+        self.sink.set_property('location', self.location)
+        self.sink.set_property('max-size-time',
+                               int(self.segment * Gst.SECOND))
+        try:
+            # finalize the segments in the background
+            self.sink.set_property('muxer-factory', self.muxer)
+            self.sink.set_property('async-finalize', True)
+        except TypeError:
+            self.sink.set_property(
+                'muxer', Gst.ElementFactory.make(self.muxer, None))
+        self.bin.add(self.sink)
+
+        branches = []
+        for (teename, padname, probe) in [
+                (video, "video", self._videoProbe),
+                (audio, "audio_%u", self._audioProbe)]:
+            tee = self.pipeline.get_by_name(teename)
+            if not tee:
+                log.warn("record: no such tee '%s'" % (teename,))
+                continue
+            queue = Gst.ElementFactory.make("queue", None)
+            queue.set_property('leaky', 2)
+            queue.set_property('max-size-time', _buffertime)
+            queue.set_property('max-size-bytes', 0)
+            queue.set_property('max-size-buffers', 0)
+            self.bin.add(queue)
+            queue.link_pads("src", self.sink, padname)
+            ghost = Gst.GhostPad.new("sink_%s" % (teename,),
+                                     queue.get_static_pad("sink"))
+            ghost.set_active(True)
+            self.bin.add_pad(ghost)
+            branches += [(tee, ghost, probe)]
+
+        self.pipeline.add(self.bin)
+        self.bin.sync_state_with_parent()
+        for (tee, ghost, probe) in branches:
+            teepad = tee.get_request_pad("src_%u")
+            teepad.add_probe(Gst.PadProbeType.BUFFER, probe)
+            teepad.link(ghost)
+            self.links += [(tee, teepad, ghost)]
+        log.info("recording to %s" % (self.location,))
+
+    def _videoProbe(self, pad, info):
+        # start with a keyframe
+        if self.stopping:
+            return Gst.PadProbeReturn.DROP
+        buf = info.get_buffer()
+        if buf.has_flags(Gst.BufferFlags.DELTA_UNIT):
+            return Gst.PadProbeReturn.DROP
+        self.started = True
+        return Gst.PadProbeReturn.REMOVE
+
+    def _audioProbe(self, pad, info):
+        # don't start before the video
+        if self.stopping or not self.started:
+            return Gst.PadProbeReturn.DROP
+        return Gst.PadProbeReturn.REMOVE
+
+    def stop(self):
+        """
+        stops the recording (the branch is removed, once the last segment
+        has been finalized)
+        """
+        if self.stopping:
+            return
+        log.info("stop recording to %s" % (self.location,))
+        self.stopping = True
+        for (tee, teepad, ghost) in self.links:
+            teepad.add_probe(Gst.PadProbeType.IDLE, self._unlink, tee, ghost)
+        self.timer = GLib.timeout_add(_finalizetimeout, self._timeout)
+
+    def _unlink(self, teepad, info, tee, ghost):
+        # called (once) when no data is flowing through 'teepad'
+        if teepad.is_linked():
+            teepad.unlink(ghost)
+            tee.release_request_pad(teepad)
+            ghost.send_event(Gst.Event.new_eos())
+        return Gst.PadProbeReturn.REMOVE
+
+    def handleMessage(self, message):
+        """
+        to be called with the ELEMENT messages of the pipeline
+        (to track the segments), in the main loop (see _finalize())
+        """
+        if message.src != self.sink:
+            return False
+        s = message.get_structure()
+        name = s and s.get_name()
+        if "splitmuxsink-fragment-opened" == name:
+            self.opened += 1
+            log.info("record: opened %s" % (s.get_value('location'),))
+        elif "splitmuxsink-fragment-closed" == name:
+            self.closed += 1
+            log.info("record: finalized %s" % (s.get_value('location'),))
+            if self.stopping and self.closed >= self.opened:
+                self._finalize()
+        else:
+            return False
+        return True
+
+    def _timeout(self):
+        self.timer = None
+        if self.closed < self.opened:
+            log.warn("record: %d segments not finalized"
+                     % (self.opened - self.closed,))
+        self._finalize()
+        return False
+
+    def _finalize(self):
+        # only ever called from the main loop (by the last closed segment,
+        # or by the timeout), so the two can't race
+        if self.finished:
+            return
+        self.finished = True
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        self.bin.set_state(Gst.State.NULL)
+        self.pipeline.remove(self.bin)
+        log.info("recording to %s done (%d segments)"
+                 % (self.location, self.closed))
+
+    def stats(self):
+        return {
+            'location': self.location,
+            'started': self.started,
+            'stopping': self.stopping,
+            'segments': self.opened,
+            'finalized': self.closed,
+        }
+
+
+# ####################################################################
+if __name__ == '__main__':
+    import sys
+    Gst.init(None)
+    logging.basicConfig(level=logging.INFO)
+    filename = "/tmp/rec.mp4"
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    pipeline = Gst.parse_launch(
+        'videotestsrc is-live=true ! x264enc tune=zerolatency key-int-max=30'
+        ' ! h264parse ! tee name=vencout ! queue ! fakesink'
+        ' audiotestsrc is-live=true ! faac ! aacparse'
+        ' ! tee name=aout ! queue ! fakesink')
+    rec = []
+
+    def onMessage(bus, message):
+        if rec:
+            rec[0].handleMessage(message)
+    bus = pipeline.get_bus()
+    bus.add_signal_watch()
+    bus.connect('message::element', onMessage)
+    pipeline.set_state(Gst.State.PLAYING)
+    loop = GLib.MainLoop()
+    GLib.timeout_add(2000, lambda: rec.append(
+        recorder(pipeline, filename, segment=5)))
+    GLib.timeout_add(14000, lambda: rec[0].stop())
+    GLib.timeout_add(16000, lambda: loop.quit())
+    loop.run()
+    pipeline.set_state(Gst.State.NULL)
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# bitrate ladder: additional renditions of the programme
+#
+# each [rendition.NAME] section of the configuration adds a branch to the
+# pipeline (replacing the @RENDITIONS@ macro), that takes the video after
+# the text-overlays (the 'vout' tee) and the encoded audio (the 'aout' tee),
+# scales and encodes the video with its own bitrate and muxes it.
+# the muxed rendition is published like an output (see outputs.py), named
+# 'rendition_NAME': with a leaky queue and a valve (so a slow or dead
+# destination never holds back the main stream), and reconnecting
+# (with the same 'enabled', 'buffer', 'reconnect' and 'backlog' options).
+#
+# [rendition.low]
+# width = 854
+# height = 480
+# bitrate = 1200
+# url = rtmp://example.com/live/low
+#
+# all renditions are bound to the same controls as the main stream
+# (e.g. 'video.delay'); additionally each encoder's bitrate is
+# controllable via 'video.bitrate.NAME'
+# the queues in front of each muxer are as large as those of the main
+# stream ([stream] muxqueue), as they have to hold the same A/V delay.
+
+from . import outputs
+
+import logging
+log = logging.getLogger(__name__)
+
+_branch = """
+vout.
+! queue name=qvenc_%(name)s
+! videoscale
+! videoconvert
+! %(caps)s
+! x264enc name=venc_%(name)s bitrate=%(bitrate)d key-int-max=60 bframes=0 \
+byte-stream=false aud=true tune=zerolatency
+! h264parse
+! video/x-h264,profile=main
+! identity name=vdelay_%(name)s silent=true
+! queue name=qvmux_%(name)s max-size-time=%(muxqueue)d max-size-bytes=0 max-size-buffers=0
+! flvmux streamable=true name=mux_%(name)s
+%(output)s
+aout.
+! queue name=qamux_%(name)s max-size-time=%(muxqueue)d max-size-bytes=0 max-size-buffers=0
+! mux_%(name)s.
+"""
+
+_defaultbitrate = 1000
+# capacity (in seconds) of the queues in front of the muxer
+_defaultmuxqueue = 3.
+
+
+def output(name):
+    """returns the name of the output of the rendition 'name'"""
+    return "rendition_%s" % (name,)
+
+
+def branch(name, width=None, height=None, bitrate=None, muxqueue=None,
+           **options):
+    """
+    returns a tuple of
+    - the pipeline description for a single rendition
+      ('muxqueue' is the capacity of the queues in front of the muxer)
+    - the reconnecting outputs {sinkname: (url, backlog)} (of 'options',
+      see outputs.outputs())
+    """
+    caps = "video/x-raw"
+    if width:
+        caps += ",width=%d" % (int(width),)
+    if height:
+        caps += ",height=%d" % (int(height),)
+    (out, _, netsinks) = outputs.outputs([(output(name), options)],
+                                         source="mux_%s" % (name,))
+    pipestring = _branch % {
+        'name': name,
+        'caps': caps,
+        'bitrate': int(float(bitrate or _defaultbitrate)),
+        'output': out,
+        'muxqueue': int(float(muxqueue or _defaultmuxqueue) * 1000000000),
+    }
+    return (pipestring, netsinks)
+
+
+def controls(name):
+    """returns the controls {NAME: {element: [property]}} of a rendition"""
+    return {
+        'video.delay': {'vdelay_%s' % (name,): ['src::offset']},
+        'video.bitrate.%s' % (name,): {'venc_%s' % (name,): ['bitrate']},
+    }
+
+
+def ladder(renditions, muxqueue=None):
+    """
+    'renditions' is a list of (NAME, {option: value}) tuples
+    (e.g. from the [rendition.NAME] sections of the configuration);
+    returns a tuple of
+    - the pipeline description for all renditions (for @RENDITIONS@)
+    - the controls {NAME: {element: [property]}} of all renditions
+    - the names of the outputs of all renditions (see output())
+    - the reconnecting outputs {sinkname: (url, backlog)}
+      (see pipeline.addNetsink())
+    """
+    pipestring = ""
+    ctrls = dict()
+    names = []
+    netsinks = dict()
+    for (name, options) in renditions:
+        log.info("rendition '%s': %s" % (name, options))
+        options = dict(options)
+        (p, n) = branch(name,
+                        width=options.pop('width', None),
+                        height=options.pop('height', None),
+                        bitrate=options.pop('bitrate', None),
+                        muxqueue=muxqueue,
+                        **options)
+        pipestring += p
+        names += [output(name)]
+        netsinks.update(n)
+        for ctl, elemprop in controls(name).items():
+            ctrls.setdefault(ctl, dict()).update(elemprop)
+    return (pipestring, ctrls, names, netsinks)
+
+
+def fromConfig(cfg, muxqueue=None):
+    """returns the ladder for all [rendition.NAME] sections in 'cfg'"""
+    prefix = "rendition."
+    renditions = [(s[len(prefix):], cfg.getSectionDict(s))
+                  for s in cfg.sections(prefix)]
+    return ladder(renditions, muxqueue)
+
+
+# ####################################################################
+if __name__ == '__main__':
+    (pipestring, ctrls, names, netsinks) = ladder([
+        ('mid', {'width': 1024, 'height': 576, 'bitrate': 2500}),
+        ('low', {'width': 854, 'height': 480, 'bitrate': 1200}),
+    ])
+    print(pipestring)
+    print(ctrls)
+    print(names)
+    print(netsinks)
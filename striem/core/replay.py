@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# instant replay
+#
+# the muxed (FLV) stream is continuously written into a ring of fixed size,
+# kept in a memory-mapped file; the oldest data is overwritten (or expired,
+# once it is older than 'length' seconds), so neither memory nor disk use
+# grow with the length of the event.
+#
+# [replay]
+# length = 300
+# size = 256
+# file = /tmp/striem-replay.ring
+#
+# - 'length' is the time (in seconds) kept in the ring
+# - 'size' is the size of the ring file (in MB)
+#
+# saving a clip (see streamer.saveReplay()) copies the last N seconds
+# (starting at a keyframe) out of the ring, and writes them to a file
+# (prepended by the stream headers, with the timestamps starting at 0)
+# in a separate thread. the data is taken from an appsink behind a leaky
+# queue (on the 'mout' tee), so the live outputs are never held back.
+
+import os
+import mmap
+import struct
+import threading
+import collections
+import logging
+
+from gi.repository import Gst
+
+log = logging.getLogger(__name__)
+
+_branch = """
+mout.
+! queue name=qreplay leaky=downstream max-size-time=2000000000 \
+max-size-bytes=0 max-size-buffers=0
+! appsink name=%(name)s sync=false async=false
+"""
+
+_defaultlength = 300.
+_defaultsize = 256 * 1024 * 1024
+
+# FLV tag types (audio, video, script data)
+_flvtags = (8, 9, 18)
+
+
+def branch(name="replay"):
+    """returns the pipeline description for the replay branch (@REPLAY@)"""
+    return _branch % {'name': name}
+
+
+class ring:
+    """
+    records of variable size, kept in a fixed-size memory-mapped file.
+    the records are stored back to back (wrapping around at the end),
+    adding a record drops the oldest records as needed.
+    """
+    def __init__(self, filename, size=_defaultsize):
+        self.size = int(size)
+        self.filename = filename
+        self.file = open(filename, 'w+b')
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        # write position
+        self.pos = 0
+        self.used = 0
+        # (offset, length, time, key)
+        self.records = collections.deque()
+
+    def __len__(self):
+        return len(self.records)
+
+    def _drop(self):
+        (_, length, _, _) = self.records.popleft()
+        self.used -= length
+
+    def add(self, data, time, key):
+        n = len(data)
+        if n > self.size:
+            return False
+        while self.records and self.used + n > self.size:
+            self._drop()
+        offset = self.pos
+        end = offset + n
+        if end <= self.size:
+            self.map[offset:end] = data
+        else:
+            first = self.size - offset
+            self.map[offset:] = data[:first]
+            self.map[:n - first] = data[first:]
+        self.pos = end % self.size
+        self.used += n
+        self.records.append((offset, n, time, key))
+        return True
+
+    def expire(self, before):
+        """drops all records older than 'before'"""
+        while self.records and self.records[0][2] < before:
+            self._drop()
+
+    def read(self, offset, length):
+        end = offset + length
+        if end <= self.size:
+            return self.map[offset:end]
+        return self.map[offset:] + self.map[:end - self.size]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+
+def _rebase(data, base):
+    """
+    shifts the timestamp of the FLV tag in 'data' by -'base' (in msec);
+    'data' is returned unchanged if it is not a (single) FLV tag
+    """
+    if len(data) < 15 or bytearray(data[:1])[0] not in _flvtags:
+        return data
+    (size,) = struct.unpack('>I', b'\0' + data[1:4])
+    if 11 + size + 4 != len(data):
+        return data
+    (lo, hi) = struct.unpack('>3sB', data[4:8])
+    (ts,) = struct.unpack('>I', b'\0' + lo)
+    ts = max(0, (ts | (hi << 24)) - base)
+    stamp = struct.pack('>I', ts & 0xFFFFFF)[1:] + \
+        struct.pack('>B', (ts >> 24) & 0xFF)
+    return data[:4] + stamp + data[8:]
+
+
+def _timestamp(data):
+    """returns the timestamp (in msec) of the FLV tag in 'data' (or None)"""
+    if len(data) < 8 or bytearray(data[:1])[0] not in _flvtags:
+        return None
+    (lo, hi) = struct.unpack('>3sB', data[4:8])
+    (ts,) = struct.unpack('>I', b'\0' + lo)
+    return ts | (hi << 24)
+
+
+class replay:
+    def __init__(self, appsink, filename, maxbytes=None, length=None):
+        """
+        keeps the last 'length' seconds (but at most 'maxbytes') of the
+        data arriving at 'appsink' in the ring file 'filename'
+        """
+        self.appsink = appsink
+        self.length = float(length or _defaultlength)
+        self.ring = ring(filename, maxbytes or _defaultsize)
+        self.lock = threading.Lock()
+        self.headers = []
+        self.inheaders = False
+        self.last = 0
+        log.info("replay: %ss (%s bytes) in '%s'"
+                 % (self.length, self.ring.size, filename))
+        appsink.set_property('emit-signals', True)
+        appsink.connect('new-sample', self._newSample)
+
+    def _newSample(self, appsink):
+        sample = appsink.emit('pull-sample')
+        if not sample:
+            return Gst.FlowReturn.OK
+        buf = sample.get_buffer()
+        data = buf.extract_dup(0, buf.get_size())
+        with self.lock:
+            if self.ring is None:
+                return Gst.FlowReturn.OK
+            if buf.has_flags(Gst.BufferFlags.HEADER):
+                # a new set of headers replaces the old one
+                if not self.inheaders:
+                    self.headers = []
+                self.inheaders = True
+                self.headers.append(data)
+                return Gst.FlowReturn.OK
+            self.inheaders = False
+            t = buf.pts
+            if t == Gst.CLOCK_TIME_NONE:
+                t = buf.dts
+            if t == Gst.CLOCK_TIME_NONE:
+                t = self.last
+            self.last = t
+            key = not buf.has_flags(Gst.BufferFlags.DELTA_UNIT)
+            self.ring.add(data, t, key)
+            self.ring.expire(t - int(self.length * Gst.SECOND))
+        return Gst.FlowReturn.OK
+
+    def clip(self, seconds):
+        """
+        returns (headers, data) for the last 'seconds', starting at the
+        last keyframe before (or, if the ring is too short, the first
+        keyframe after)
+        """
+        with self.lock:
+            if self.ring is None:
+                return (list(self.headers), [])
+            records = list(self.ring.records)
+            if not records:
+                return (list(self.headers), [])
+            start = records[-1][2] - int(seconds * Gst.SECOND)
+            first = None
+            for (idx, (_, _, t, key)) in enumerate(records):
+                if not key:
+                    continue
+                if first is None or t <= start:
+                    first = idx
+                if t > start:
+                    break
+            if first is None:
+                return (list(self.headers), [])
+            data = [self.ring.read(offset, length)
+                    for (offset, length, _, _) in records[first:]]
+            return (list(self.headers), data)
+
+    def save(self, seconds, filename):
+        """
+        writes the last 'seconds' to 'filename' (in a separate thread);
+        returns the thread
+        """
+        (headers, data) = self.clip(seconds)
+        if not data:
+            log.warn("replay: nothing to save")
+            return None
+        t = threading.Thread(target=self._write,
+                             args=(filename, headers, data))
+        t.daemon = True
+        t.start()
+        return t
+
+    def _write(self, filename, headers, data):
+        base = _timestamp(data[0]) or 0
+        try:
+            with open(filename, 'wb') as f:
+                for h in headers:
+                    f.write(h)
+                for d in data:
+                    f.write(_rebase(d, base))
+        except IOError:
+            log.exception("replay: cannot write '%s'" % (filename,))
+            return
+        log.info("replay: saved %d tags to '%s'" % (len(data), filename))
+
+    def stats(self):
+        with self.lock:
+            if self.ring is None:
+                return None
+            records = self.ring.records
+            duration = 0
+            if records:
+                duration = records[-1][2] - records[0][2]
+            return {
+                'bytes': self.ring.used,
+                'records': len(records),
+                'duration': duration / float(Gst.SECOND),
+            }
+
+    def stop(self):
+        with self.lock:
+            if self.ring is not None:
+                self.ring.close()
+            self.ring = None
+
+
+# ####################################################################
+if __name__ == '__main__':
+    import sys
+    from gi.repository import GLib
+    Gst.init(None)
+    logging.basicConfig(level=logging.INFO)
+    filename = "/tmp/replay.flv"
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    pipeline = Gst.parse_launch(
+        'videotestsrc is-live=true ! x264enc tune=zerolatency key-int-max=30'
+        ' ! h264parse ! flvmux streamable=true name=mux ! tee name=mout'
+        ' audiotestsrc is-live=true ! faac ! aacparse ! mux.' + branch())
+    rep = replay(pipeline.get_by_name('replay'), '/tmp/replay.ring',
+                 maxbytes=16 * 1024 * 1024, length=20)
+    pipeline.set_state(Gst.State.PLAYING)
+
+    def save():
+        print(rep.stats())
+        rep.save(5, filename)
+        return False
+    GLib.timeout_add(10000, save)
+    loop = GLib.MainLoop()
+    GLib.timeout_add(11000, lambda: loop.quit())
+    loop.run()
+    pipeline.set_state(Gst.State.NULL)
+    rep.stop()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# standby video sources
+#
+# each [source.NAME] section of the configuration adds a video input
+# (replacing the @SOURCES@ macro), that feeds the 'vsel' input-selector:
+#
+# [source.cama]
+# pipeline = v4l2src device=/dev/video0
+#
+# [source.slate]
+# pipeline = filesrc location=slate.png ! pngdec ! imagefreeze is-live=true
+#
+# all inputs are running (pre-rolled) all the time, and are converted to the
+# (fixed) caps following the selector, so switching between them
+# (see streamer.selectSource()) happens with the next frame, without any
+# state change or renegotiation (and the encoder keeps running).
+# the inputs should be live sources (they are synchronized to the clock).
+# each input has a small leaky queue, so a stalled camera never blocks
+# the other inputs; the last element of each input is named 'source_NAME'.
+# without [source.NAME] sections, there's a single (test) input "test".
+
+import logging
+log = logging.getLogger(__name__)
+
+_branch = """
+%(pipeline)s
+! queue name=qsrc_%(name)s leaky=downstream max-size-buffers=2 \
+max-size-bytes=0 max-size-time=0
+! videorate
+! videoscale
+! videoconvert name=source_%(name)s
+! %(selector)s.
+"""
+
+_defaultsource = "videotestsrc pattern=18 is-live=true"
+
+
+def element(name):
+    """returns the name of the last element of the input 'name'"""
+    return "source_%s" % (name,)
+
+
+def branch(name, pipeline=None, selector="vsel"):
+    """returns the pipeline description for a single input"""
+    return _branch % {
+        'name': name,
+        'pipeline': pipeline or _defaultsource,
+        'selector': selector,
+    }
+
+
+def sources(inputs, selector="vsel"):
+    """
+    'inputs' is a list of (NAME, {option: value}) tuples
+    (e.g. from the [source.NAME] sections of the configuration);
+    returns a tuple of
+    - the pipeline description for all inputs (for @SOURCES@)
+    - the names of the inputs
+    """
+    pipestring = ""
+    names = []
+    for (name, options) in inputs:
+        log.info("source '%s': %s" % (name, options))
+        pipestring += branch(name, options.get('pipeline'), selector)
+        names += [name]
+    return (pipestring, names)
+
+
+def fromConfig(cfg):
+    """returns the inputs for all [source.NAME] sections in 'cfg'"""
+    prefix = "source."
+    inputs = [(s[len(prefix):], cfg.getSectionDict(s))
+              for s in cfg.sections(prefix)]
+    if not inputs:
+        inputs = [("test", {})]
+    return sources(inputs)
+
+
+# ####################################################################
+if __name__ == '__main__':
+    (pipestring, names) = sources([
+        ('cama', {'pipeline': 'v4l2src device=/dev/video0'}),
+        ('slate', {'pipeline': 'videotestsrc pattern=black is-live=true'}),
+    ])
+    print(pipestring)
+    print(names)
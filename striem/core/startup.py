@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# startup timeline
+#
+# the time from the start of the application to each milestone
+# (modules imported, GUI shown, pipeline PLAYING, first encoded frame,...)
+# is logged (at INFO level, so run with '-v'), to see what makes
+# a (re)start slow.
+# each milestone is only recorded the first time it is reached.
+# this module must stay cheap to import (no GStreamer, no Qt).
+
+import time
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+_start = None
+_marks = []
+_lock = threading.Lock()
+
+
+def begin(t=None):
+    """sets the start of the timeline (default: now)"""
+    global _start
+    if t is None:
+        t = time.time()
+    _start = t
+
+
+def mark(what):
+    """records (and logs) that the milestone 'what' has been reached"""
+    with _lock:
+        if _start is None:
+            begin()
+        if marked(what):
+            return None
+        t = time.time() - _start
+        _marks.append((what, t))
+    log.info("%7.3fs %s" % (t, what))
+    return t
+
+
+def marked(what):
+    """whether the milestone 'what' has already been reached"""
+    return what in [m for (m, _) in _marks]
+
+
+def timeline():
+    """returns a list of (milestone, seconds since start) tuples"""
+    return list(_marks)
+
+
+# ####################################################################
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    begin()
+    time.sleep(0.1)
+    mark("slept")
+    mark("slept")
+    time.sleep(0.2)
+    mark("slept again")
+    print(timeline())
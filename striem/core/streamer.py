@@ -30,12 +30,27 @@ import re
 
 from . import configuration
 from . import pipeline
+from . import renditions
+from . import outputs
+from . import sources
+from . import replay
 
 import logging
 log = logging.getLogger(__name__)
 
 _db = math.log(10) / 20
 
+# fade times (in seconds), to avoid clicks when changing the gain
+# and hard cuts when (un)muting
+_gainramp = 0.05
+_muteramp = 1
+
+# capacity (in seconds) of the queues in front of the muxer (@MUXQUEUE@),
+# which bounds the A/V delay (see pipelines/README.txt); the queues keep
+# some room beyond the delay for the interleaving
+_defaultmuxqueue = 3.
+_muxheadroom = 0.5
+
 ESCAPE_SEQUENCE_RE = re.compile(r'''
     ( \\U........      # 8-digit hex escapes
     | \\u....          # 4-digit hex escapes
@@ -57,33 +72,168 @@ def decode_escapes(s):
         return s.decode('string_escape')
 
 class streamer:
-    def __init__(self, configfile=None, configvalues={}, pipedefaults={}):
+    def __init__(self, configfile=None, configvalues={}, pipedefaults={},
+                 defer=False):
+        """
+        if 'defer' is True, the pipeline is only built by setup()
+        (so the GUI can be shown first)
+        """
         self.cfgbak = configuration.configuration(
             filename=configfile,
             defaultvalues=configvalues)
         self.cfg = configuration.configuration(self.cfgbak)
+        self.pip = None
+        self.meter = None
+        self.sources = []
+        self.outputs = []
+        self.renditions = []
+        self.gui = None
+        self.eventkeys = dict()
+        self.meterhandlers = []
+        self.running = None
+        self.pipedefaults = pipedefaults
+        # state that is not kept in the configuration
+        self.texts = dict()
+        self.textshown = False
+        self.videoshown = None
+        if not defer:
+            self.setup()
+
+    def setup(self):
+        """builds the pipeline (unless this has already been done)"""
+        if self.pip:
+            return
         pipekeys = dict()
         cpk = self.cfg.getSectionDict('pipeline')
         for k in cpk:
             pipekeys[k.upper()] = cpk[k]
 
+        pipekeys['MUXQUEUE'] = int(self._muxqueue() * 1000000000)
+        for k in ['width', 'height', 'fps']:
+            pipekeys['PREVIEW_' + k.upper()] = self.cfg.get("GUI",
+                                                            "preview." + k)
+        (pipekeys['SOURCES'], self.sources) = sources.fromConfig(self.cfg)
+        (pipekeys['RENDITIONS'], controls, self.renditions, netsinks) = \
+            renditions.fromConfig(self.cfg, self._muxqueue())
+        (pipekeys['OUTPUTS'], self.outputs, n) = \
+            outputs.fromConfig(self.cfg)
+        netsinks.update(n)
+        replayfile = self.cfg.get("replay", "file")
+        if replayfile:
+            pipekeys['REPLAY'] = replay.branch()
+
         pipefile = self.cfg.get("stream", "pipeline")
         if not pipefile:
             pipefile = "core/pipelines/striem.gst"
-        self.pip = pipeline.pipeline(pipefile, pipekeys)
-        self.setGui = self.pip.setGui
-        self.run = self.pip.run
-        self.addEventKeyHandlers = self.pip.setEventKeys
-        if pipedefaults:
-            for k, v in pipedefaults.items():
+        self.pip = pipeline.pipeline(
+            pipefile, pipekeys,
+            instrument=self.cfg.get("stream", "instrument"),
+            controls=controls)
+        for sinkname, (url, backlog) in netsinks.items():
+            self.pip.addNetsink(sinkname, url, backlog)
+        for o in self.outputs + self.renditions:
+            self.pip.addValve(o)
+        if replayfile:
+            size = self.cfg.get("replay", "size")
+            if size:
+                size = int(size * 1024 * 1024)
+            self.pip.addReplay("replay", replayfile, size,
+                               self.cfg.get("replay", "length"))
+        self._setupQueues()
+        self._setupBitrate()
+        self.meter = self.pip.addMeter(
+            "alevel", self.cfg.get("GUI", "meter.interval"))
+        if self.meter:
+            for fun in self.meterhandlers:
+                self.meter.subscribe(fun)
+        self.stats = self.pip.stats
+        self.bitrateStats = self.pip.bitrateStats
+        self.pip.setEventKeys(self.eventkeys)
+        self._applySettings()
+        if self.pipedefaults:
+            for k, v in self.pipedefaults.items():
                 (element, _, prop) = k.partition('.')
                 self.pip.setControl(k, v)
                 self.pip.setProperty(element, prop, v)
-        self.showText(False)
+        source = self.cfg.get("video", "source")
+        if source:
+            self.selectSource(source)
+        self.pip.setGui(self.gui)
+        if self.running is not None:
+            self.pip.run(self.running)
+
+    def _applySettings(self):
+        # (re)applies the settings made before the pipeline was built
+        gain = self.cfg.get("audio", "gain")
+        if gain is not None:
+            self.setAGain(gain)
+        for (section, setter) in [("audio", self.setADelay),
+                                  ("video", self.setVDelay)]:
+            delay = self.cfg.get(section, "delay")
+            if delay is not None:
+                setter(delay)
+        for id in ["piece", "composer", "interpret"]:
+            face = self.cfg.get(id, "text.face")
+            size = self.cfg.get(id, "text.size")
+            if face is not None and size is not None:
+                self.setTextFont(id, face, size)
+            y = self.cfg.get(id, "text.Y")
+            if y is not None:
+                self.setTextPosition(id, y)
+        for (id, txt) in self.texts.items():
+            self.pip.setControl("text." + id, txt)
+        self.showText(self.textshown)
+        if self.videoshown is not None:
+            self.showVideo(self.videoshown)
+
+    def setGui(self, gui):
+        self.gui = gui
+        if self.pip:
+            self.pip.setGui(gui)
+
+    def run(self, state=True):
+        self.running = state
+        if self.pip:
+            self.pip.run(state)
+
+    def addEventKeyHandlers(self, handlers=dict()):
+        self.eventkeys.update(handlers)
+        if self.pip:
+            self.pip.setEventKeys(handlers)
+
+    def addMeterHandler(self, fun):
+        """
+        calls fun({'rms': [...], 'peak': [...], 'decay': [...]})
+        (in dB per channel) once per meter interval (see meter.py)
+        """
+        self.meterhandlers.append(fun)
+        if self.meter:
+            self.meter.subscribe(fun)
+
+    def _setupQueues(self):
+        prefix = "queue."
+        for section in self.cfg.sections(prefix):
+            self.pip.setQueuePolicy(section[len(prefix):],
+                                    self.cfg.getSectionDict(section))
+        interval = self.cfg.get("stream", "queuereport")
+        if interval is None:
+            interval = 1.
+        self.pip.reportQueues(interval)
+
+    def _setupBitrate(self):
+        minimum = self.cfg.get("bitrate", "min")
+        maximum = self.cfg.get("bitrate", "max")
+        if not minimum or not maximum:
+            return
+        encoder = self.cfg.get("bitrate", "encoder") or "venc"
+        queues = ["queue_%s" % (o,) for o in self.outputs]
+        self.pip.addBitrateController(encoder, queues, minimum, maximum,
+                                      logfile=self.cfg.get("bitrate", "log"))
 
     def teardown(self):
         self.cfg.save()
-        self.pip.run(False)
+        if self.pip:
+            self.pip.run(False)
 
     def apply(self):
         self.cfgbak = configuration.configuration(self.cfg)
@@ -107,41 +257,53 @@ class streamer:
         f = 0
         if(value > -100):
             f = math.exp(_db * value)
-        self.pip.setControl("audio.gain", f)
+        if self.pip:
+            self.pip.setControl("audio.gain", f, _gainramp)
+
+    def _muxqueue(self):
+        return self.cfg.get("stream", "muxqueue") or _defaultmuxqueue
+
+    def maxDelay(self):
+        """the maximum A/V delay (in msec)"""
+        return int(max(self._muxqueue() - _muxheadroom, 0) * 1000)
 
     def setADelay(self, value):
         # value in msec, but we need nanosec
         if(value < 0):
             value = 0
-        if(value > 1000):
-            value = 1000
+        if(value > self.maxDelay()):
+            value = self.maxDelay()
         f = value * 1000000
         log.debug("adelay: %s = %s" % (value, f))
-        self.pip.setControl("audio.delay", f)
         self.cfg.set("audio", "delay", value)
+        if self.pip:
+            self.pip.setControl("audio.delay", f)
 
     def setVDelay(self, value):
-        # value in msec, but we need microseconds
+        # value in msec, but we need nanosec
         if(value < 0):
             value = 0
-        if(value > 1000):
-            value = 1000
-        f = value * 10000
+        if(value > self.maxDelay()):
+            value = self.maxDelay()
+        f = value * 1000000
         log.info("vdelay: %s = %s" % (value, f))
-        self.pip.setControl("video.delay", f)
         self.cfg.set("video", "delay", value)
+        if self.pip:
+            self.pip.setControl("video.delay", f)
 
     def setTextFont(self, ID, face, size):
         desc = str(face) + " " + str(size)
         self.cfg.set(ID, "text.face", face)
         self.cfg.set(ID, "text.size", size)
         log.debug("Font['%s']: %s" % (ID, desc))
-        self.pip.setControl("font." + ID, desc)
+        if self.pip:
+            self.pip.setControl("font." + ID, desc)
 
     def setTextPosition(self, ID, y):
         self.cfg.set(ID, "text.Y", y)
         log.debug("Font['%s']: %f" % (ID, y))
-        self.pip.setControl("posY." + ID, y)
+        if self.pip:
+            self.pip.setControl("posY." + ID, y)
 
     def setTextDecoration(self, ID, deco):
         self.cfg.set(ID, "text.decoration", int(bool(deco)))
@@ -157,10 +319,14 @@ class streamer:
             txt = decode_escapes(txt)
         else:
             txt = ""
-        self.pip.setControl("text." + ID, txt)
+        self.texts[ID] = txt
+        if self.pip:
+            self.pip.setControl("text." + ID, txt)
 
     def showText(self, state):
-        self.pip.setControl("text.hide", not state)
+        self.textshown = state
+        if self.pip:
+            self.pip.setControl("text.hide", not state)
 
     def showVideo(self, state):
         mute = not state
@@ -172,8 +338,11 @@ class streamer:
             v = 1.
             a = 1.
         log.debug("showVideo(%s): audio = %s video = %s" % (state, a, v))
-        self.pip.setControl("video.mute", v, 1)
-        self.pip.setControl("audio.mute", a)
+        self.videoshown = state
+        if not self.pip:
+            return
+        self.pip.setControl("video.mute", v, _muteramp)
+        self.pip.setControl("audio.mute", a, _muteramp)
 
     def getAGain(self):
         v = self.cfg.get("audio", "gain")
@@ -198,8 +367,36 @@ class streamer:
         deco = self.cfg.get(id, "text.decoration")
         return deco
 
-    def streamPause(self, state):
-        return self.pip.pause(state, "stream")
+    def streamPause(self, state, output=None):
+        """stops (state=True) or (re)starts an output (default: all)"""
+        if not self.pip:
+            return False
+        if output:
+            return self.pip.pause(state, output)
+        for o in self.outputs + self.renditions:
+            self.pip.pause(state, o)
+        return state
+
+    def selectSource(self, name):
+        """switches the video to the input 'name' (see sources.py)"""
+        if name not in self.sources:
+            log.warn("unknown source '%s' (use one of %s)"
+                     % (name, self.sources))
+            return False
+        self.cfg.set("video", "source", name)
+        if not self.pip:
+            return False
+        return self.pip.select("vsel", sources.element(name))
+
+    def getSource(self):
+        return self.cfg.get("video", "source") or \
+            (self.sources and self.sources[0]) or None
+
+    def saveReplay(self, seconds, filename):
+        """writes the last 'seconds' of the stream to 'filename'"""
+        if not self.pip:
+            return None
+        return self.pip.saveReplay(seconds, filename)
 
     def getConfig(self, section, property):
         res = self.cfg.get(section, property)
@@ -207,4 +404,9 @@ class streamer:
         return res
 
     def record(self, filename=None):
-        self.pip.record(filename)
+        """starts (or stops, if no filename is given) recording"""
+        if not self.pip:
+            return False
+        return self.pip.record(filename,
+                               self.cfg.get("record", "segment"),
+                               self.cfg.get("record", "muxer"))
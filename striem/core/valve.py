@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014, IOhannes m zmölnig, IEM
+
+# This file is part of striem
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with striem.  If not, see <http://www.gnu.org/licenses/>.
+
+# decodable (re)opening of an output valve
+#
+# a valve in front of an output (see outputs.py) passes the muxed stream
+# as is: simply opening it would resume in the middle of a GOP, and
+# without the stream headers (that the muxer only sends at the start).
+# so the header buffers (flagged HEADER) passing the valve's sink pad are
+# kept (even while the valve is closed), and a valve that is reopened
+# keeps dropping until the next keyframe (a buffer without DELTA_UNIT);
+# the headers are then sent right in front of that keyframe.
+
+import threading
+import logging
+
+from gi.repository import Gst
+
+log = logging.getLogger(__name__)
+
+
+class valve:
+    def __init__(self, lmn):
+        """controls the 'valve' element 'lmn'"""
+        self.element = lmn
+        self.lock = threading.Lock()
+        self.headers = []
+        self.inheaders = False
+        # waiting for a keyframe to reopen
+        self.waiting = False
+        # the headers are being re-sent (through our own probe)
+        self.resending = False
+        self.sinkpad = lmn.get_static_pad("sink")
+        self.sinkpad.add_probe(Gst.PadProbeType.BUFFER, self._probe)
+
+    def set(self, drop):
+        """closes (drop=True) or (re)opens the valve"""
+        with self.lock:
+            if drop:
+                self.waiting = False
+                self.element.set_property("drop", True)
+            elif self.element.get_property("drop"):
+                # reopened by _probe()
+                self.waiting = True
+
+    def _probe(self, pad, info):
+        # (streaming thread)
+        if self.resending:
+            return Gst.PadProbeReturn.OK
+        buf = info.get_buffer()
+        with self.lock:
+            if buf.has_flags(Gst.BufferFlags.HEADER):
+                # a new set of headers replaces the old one
+                if not self.inheaders:
+                    self.headers = []
+                self.inheaders = True
+                self.headers.append(buf)
+                return Gst.PadProbeReturn.OK
+            self.inheaders = False
+            if not self.waiting:
+                return Gst.PadProbeReturn.OK
+            if buf.has_flags(Gst.BufferFlags.DELTA_UNIT):
+                return Gst.PadProbeReturn.DROP
+            self.waiting = False
+            headers = list(self.headers)
+            self.element.set_property("drop", False)
+        log.debug("%s: reopened at a keyframe (%d headers)"
+                  % (self.element.get_name(), len(headers)))
+        # through the valve's chain function (which sends the sticky
+        # events that were dropped while it was closed)
+        self.resending = True
+        try:
+            for h in headers:
+                pad.chain(h)
+        finally:
+            self.resending = False
+        return Gst.PadProbeReturn.OK
+
+
+# ####################################################################
+if __name__ == '__main__':
+    from gi.repository import GLib
+    Gst.init(None)
+    logging.basicConfig(level=logging.DEBUG)
+    pipeline = Gst.parse_launch(
+        'videotestsrc is-live=true ! x264enc tune=zerolatency key-int-max=30'
+        ' ! h264parse ! flvmux streamable=true'
+        ' ! valve name=out drop=true ! filesink location=/tmp/valve.flv')
+    v = valve(pipeline.get_by_name('out'))
+    pipeline.set_state(Gst.State.PLAYING)
+    loop = GLib.MainLoop()
+    GLib.timeout_add(2500, lambda: v.set(False))
+    GLib.timeout_add(6000, lambda: loop.quit())
+    loop.run()
+    pipeline.set_state(Gst.State.NULL)
@@ -44,6 +44,12 @@ class streamcontrols(QtGui.QDialog, streamcontrols_ui.Ui_streamControls):
 
         self.closefunction = closefunction
         self.setupUi(self)
+        if self.streamer:
+            # the delays are bounded by the queues in front of the muxer
+            maxdelay = self.streamer.maxDelay()
+            for w in [self.adelaySlider, self.adelayValue,
+                      self.vdelaySlider, self.vdelayValue]:
+                w.setMaximum(maxdelay)
         self.setupConnections()
 
     def setupConnections(self):
@@ -192,12 +198,15 @@ class streamcontrols(QtGui.QDialog, streamcontrols_ui.Ui_streamControls):
     def reject(self):
         self.accept(False)
 
-    def setAudioLevels(self, rmsvalues, _):
+    def setAudioLevels(self, levels):
+        if not self.aLevel:
+            return
+        rmsvalues = levels.get('rms')
+        if not rmsvalues:
+            return
         rmsdb = max(rmsvalues)
-        vclipped = min(max(rmsdb + 100, 0), 100)
-        log.debug("level(%s): %s -> %s = > %s" %
-                  (self.aLevel, rmsvalues, rmsdb, vclipped))
-        if self.aLevel:
+        vclipped = int(min(max(rmsdb + 100, 0), 100))
+        if vclipped != self.aLevel.value():
             self.aLevel.setValue(vclipped)
 
 ######################################################################
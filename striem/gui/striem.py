@@ -80,8 +80,7 @@ class striem(QtGui.QMainWindow, striem_ui.Ui_striem):
                 if foo is not None:
                     self.allowClose = bool(int(foo))
 
-            self.streamer.addEventKeyHandlers(
-                {'rms': self.streamcontrol.setAudioLevels})
+            self.streamer.addMeterHandler(self.streamcontrol.setAudioLevels)
 
         # ignore Alt-F4 and window-close events
         if self.allowClose: